@@ -0,0 +1,110 @@
+# Copyright (C) 2023 github.com/ping
+#
+# This file is part of odmpy.
+#
+# odmpy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# odmpy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with odmpy.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import logging
+import os
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Optional
+
+from .utils import slugify, json_loads, json_dumps_bytes
+
+#
+# Simple on-disk json cache.
+# The expiry time of an entry is stored as the cache file's mtime.
+#
+
+logger = logging.getLogger(__name__)
+
+
+def _cache_file(cache_folder: Path, key: str) -> Path:
+    return cache_folder.joinpath(f"{slugify(key, allow_unicode=False)}.json")
+
+
+def get(cache_folder: Path, key: str) -> Optional[Any]:
+    """
+    Get a cached value.
+
+    :param cache_folder:
+    :param key:
+    :return: None if not cached or expired
+    """
+    cache_file = _cache_file(cache_folder, key)
+    try:
+        if cache_file.stat().st_mtime < time.time():
+            cache_file.unlink()
+            return None
+        return json_loads(cache_file.read_bytes())
+    except (OSError, ValueError):
+        return None
+
+
+def put(cache_folder: Path, key: str, value: Any, ttl: int) -> None:
+    """
+    Cache a json-serializable value.
+    Errors are only logged since the cache is optional.
+    Expired entries, e.g. for keys that are no longer used, are removed here.
+
+    :param cache_folder:
+    :param key:
+    :param value:
+    :param ttl: Time-to-live in seconds
+    :return:
+    """
+    try:
+        cache_folder.mkdir(parents=True, exist_ok=True)
+        _remove_expired(cache_folder)
+        cache_file = _cache_file(cache_folder, key)
+        # write to a temp file first so that a partial write is never read
+        fd, tmp_name = tempfile.mkstemp(dir=cache_folder, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(json_dumps_bytes(value))
+            expires_at = time.time() + ttl
+            os.utime(tmp_name, (expires_at, expires_at))
+            os.replace(tmp_name, cache_file)
+        except BaseException:
+            os.unlink(tmp_name)
+            raise
+    except OSError as err:
+        logger.debug('Unable to cache "%s": %s', key, err)
+
+
+def _remove_expired(cache_folder: Path) -> None:
+    now = time.time()
+    for cache_file in cache_folder.glob("*.json"):
+        try:
+            if cache_file.stat().st_mtime < now:
+                cache_file.unlink()
+        except OSError:
+            pass
+
+
+def clear(cache_folder: Path) -> None:
+    """
+    Remove all cached entries.
+
+    :param cache_folder:
+    :return:
+    """
+    for cache_file in cache_folder.glob("*"):
+        try:
+            cache_file.unlink()
+        except OSError:
+            pass
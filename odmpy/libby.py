@@ -17,13 +17,16 @@
 #
 import json
 import logging
+import os
 import re
+import shutil
 import sys
 from collections import OrderedDict
+from contextlib import closing
 from datetime import datetime, timezone
 from enum import Enum
 from pathlib import Path
-from typing import Optional, NamedTuple, Dict, List, Tuple
+from typing import IO, Optional, NamedTuple, Dict, List, Set, Tuple, cast
 from typing import OrderedDict as OrderedDictType
 from urllib import request
 from urllib.parse import urljoin
@@ -36,7 +39,9 @@ else:
 import requests
 from requests.adapters import HTTPAdapter, Retry
 
+from . import cache
 from .libby_errors import ClientConnectionError, ClientTimeoutError, ErrorHandler
+from .utils import json_loads
 
 #
 # Client for the Libby web API, and helper functions to make sense
@@ -100,6 +105,8 @@ class LibbyMediaTypes(str, Enum):
 FILE_PART_RE = re.compile(
     r"(?P<part_name>{[A-F0-9\-]{36}}[^#]+)(#(?P<second_stamp>\d+(\.\d+)?))?$"
 )
+# buffer size used when streaming downloads to disk
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
 USER_AGENT = (
     "Mozilla/5.0 (Macintosh; Intel Mac OS X 11_1) AppleWebKit/605.1.15 (KHTML, like Gecko) "
     "Version/14.0.2 Safari/605.1.15"
@@ -118,6 +125,12 @@ DOWNLOADABLE_FORMATS = (
     LibbyFormats.EBookPDFOpen,
     LibbyFormats.MagazineOverDrive,
 )
+# the media type a loan is downloadable as, by format
+DOWNLOADABLE_FORMAT_MEDIA_TYPES: Dict[str, LibbyMediaTypes] = {
+    LibbyFormats.AudioBookMP3: LibbyMediaTypes.Audiobook,
+    **{f: LibbyMediaTypes.EBook for f in EBOOK_DOWNLOADABLE_FORMATS},
+    LibbyFormats.MagazineOverDrive: LibbyMediaTypes.Magazine,
+}
 
 
 def parse_part_path(title: str, part_path: str) -> ChapterMarker:
@@ -254,6 +267,7 @@ class LibbyClient(object):
         max_retries: int = 0,
         timeout: int = 10,
         logger: Optional[logging.Logger] = None,
+        pool_maxsize: int = 32,
         **kwargs,
     ) -> None:
         if not logger:
@@ -271,6 +285,9 @@ class LibbyClient(object):
             if self.settings_folder
             else None
         )
+        self.cache_folder = (
+            self.settings_folder.joinpath("cache") if self.settings_folder else None
+        )
         if self.identity_settings_file and self.identity_settings_file.exists():
             with self.identity_settings_file.open("r", encoding="utf-8") as f:
                 self.identity = json.load(f)
@@ -285,7 +302,13 @@ class LibbyClient(object):
 
         self.max_retries = max_retries
         libby_session = requests.Session()
-        adapter = HTTPAdapter(max_retries=Retry(total=max_retries, backoff_factor=0.1))
+        adapter = HTTPAdapter(
+            # larger pool so that connections are kept when fetching concurrently,
+            # e.g. audiobook part files
+            pool_connections=16,
+            pool_maxsize=pool_maxsize,
+            max_retries=Retry(total=max_retries, backoff_factor=0.1),
+        )
         for prefix in ("http://", "https://"):
             libby_session.mount(prefix, adapter)
         self.libby_session = libby_session
@@ -321,6 +344,7 @@ class LibbyClient(object):
         session: Optional[requests.sessions.Session] = None,
         return_res: bool = False,
         allow_redirects: bool = True,
+        stream: bool = False,
     ):
         endpoint_url = urljoin(self.api_base, endpoint)
         if not method:
@@ -351,13 +375,16 @@ class LibbyClient(object):
                 session.prepare_request(req),
                 timeout=self.timeout,
                 allow_redirects=allow_redirects,
+                stream=stream,
             )
-            self.logger.debug("body: %s", res.text)
+            if not stream:
+                # reading the text would consume a streamed body
+                self.logger.debug("body: %s", res.text)
 
             res.raise_for_status()
             if return_res:
                 return res
-            return res.json()
+            return json_loads(res.content)
         except requests.ConnectionError as conn_err:
             raise ClientConnectionError(str(conn_err)) from conn_err
         except requests.Timeout as timeout_err:
@@ -389,6 +416,8 @@ class LibbyClient(object):
         if self.identity_settings_file and self.identity_settings_file.exists():
             self.identity_settings_file.unlink()
         self.identity = {}
+        if self.cache_folder:
+            cache.clear(self.cache_folder)
 
     def has_chip(self) -> bool:
         """
@@ -554,6 +583,22 @@ class LibbyClient(object):
             ]
         )
 
+    @staticmethod
+    def get_downloadable_media_types(book: Dict) -> Set[LibbyMediaTypes]:
+        """
+        Get the media types that a loan is downloadable as.
+        Equivalent to the combined `is_downloadable_*_loan()` checks
+        but with only one pass over the loan formats.
+
+        :param book:
+        :return:
+        """
+        return {
+            DOWNLOADABLE_FORMAT_MEDIA_TYPES[f["id"]]
+            for f in book.get("formats", [])
+            if f["id"] in DOWNLOADABLE_FORMAT_MEDIA_TYPES
+        }
+
     @staticmethod
     def has_format(loan: Dict, format_id: str) -> bool:
         return bool(
@@ -710,11 +755,10 @@ class LibbyClient(object):
         return res
 
     @staticmethod
-    def _urlretrieve(
-        endpoint: str, headers: Optional[Dict] = None, timeout: int = 15
-    ) -> bytes:
+    def _urlopen(endpoint: str, headers: Optional[Dict] = None, timeout: int = 15):
         """
         Workaround for downloading an open (non-drm) epub or pdf.
+        Opens the url with urllib instead of requests.
 
         The fulfillment url 403s when using requests but
         works in curl, request.urlretrieve, etc.
@@ -743,14 +787,12 @@ class LibbyClient(object):
 
         opener = request.build_opener()
         req = request.Request(endpoint, headers=headers)
-        res = opener.open(req, timeout=timeout)
-        return res.read()
+        return opener.open(req, timeout=timeout)
 
-    def fulfill_loan_file(self, loan_id: str, card_id: str, format_id: str) -> bytes:
+    def _open_loan_file(self, loan_id: str, card_id: str, format_id: str) -> IO[bytes]:
         """
-        Returns the loan file contents directly for MP3 audiobooks (.odm)
-        and DRM epub (.acsm) loans.
-        For open epub/pdf loans, the actual epub/pdf contents are returned.
+        Opens the loan file for reading. See `fulfill_loan_file()`.
+        The caller should close the returned stream.
 
         :param loan_id:
         :param card_id:
@@ -770,7 +812,7 @@ class LibbyClient(object):
                 return_res=True,
                 allow_redirects=False,
             )
-            return self._urlretrieve(
+            return self._urlopen(
                 res_redirect.headers["Location"], headers=headers, timeout=self.timeout
             )
 
@@ -778,8 +820,52 @@ class LibbyClient(object):
             f"card/{card_id}/loan/{loan_id}/fulfill/{format_id}",
             headers=headers,
             return_res=True,
+            stream=True,
         )
-        return res.content
+        res.raw.decode_content = True
+        return cast(IO[bytes], res.raw)
+
+    def fulfill_loan_file(self, loan_id: str, card_id: str, format_id: str) -> bytes:
+        """
+        Returns the loan file contents directly for MP3 audiobooks (.odm)
+        and DRM epub (.acsm) loans.
+        For open epub/pdf loans, the actual epub/pdf contents are returned.
+
+        :param loan_id:
+        :param card_id:
+        :param format_id:
+        :return:
+        """
+        with closing(self._open_loan_file(loan_id, card_id, format_id)) as loan_file:
+            return loan_file.read()
+
+    def fulfill_loan_file_to_path(
+        self, loan_id: str, card_id: str, format_id: str, file_path: Path
+    ) -> None:
+        """
+        Same as `fulfill_loan_file()` but streams the contents into `file_path`
+        instead of returning them, so that large open epub/pdf loans
+        are not held in memory.
+        The file is only created if the download completes.
+
+        :param loan_id:
+        :param card_id:
+        :param format_id:
+        :param file_path:
+        :return:
+        """
+        partial_file_path = file_path.with_name(f"{file_path.name}.part")
+        try:
+            with closing(
+                self._open_loan_file(loan_id, card_id, format_id)
+            ) as loan_file, partial_file_path.open("wb") as f:
+                shutil.copyfileobj(loan_file, f, length=DOWNLOAD_CHUNK_SIZE)
+            os.replace(partial_file_path, file_path)
+        finally:
+            try:
+                partial_file_path.unlink()
+            except FileNotFoundError:
+                pass
 
     def open_loan(self, loan_type: str, card_id: str, title_id: str) -> Dict:
         """
@@ -834,6 +920,7 @@ class LibbyClient(object):
         """
         download_base, meta = self.prepare_loan(loan)
         # contains nav/toc and spine
+        # not cached because the part urls are signed for this loan session
         openbook = self.make_request(meta["urls"]["openbook"])
         toc = parse_toc(download_base, openbook["nav"]["toc"], openbook["spine"])
         return openbook, toc
@@ -17,16 +17,20 @@
 #
 
 import argparse
+import atexit
+import contextlib
 import io
-import json
 import logging
 import os
 import sys
+import threading
 import time
 from http.client import HTTPConnection
+from operator import itemgetter
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
 
+import requests
 from termcolor import colored
 
 from .cli_utils import (
@@ -37,7 +41,7 @@ from .cli_utils import (
     DEFAULT_FORMAT_FIELDS,
 )
 from .errors import LibbyNotConfiguredError, OdmpyRuntimeError
-from .libby import LibbyClient, LibbyFormats
+from .libby import LibbyClient, LibbyFormats, LibbyMediaTypes
 from .libby_errors import ClientBadRequestError, ClientError
 from .overdrive import OverDriveClient
 from .processing import (
@@ -53,7 +57,7 @@ from .processing.shared import (
     init_session,
     extract_authors_from_openbook,
 )
-from .utils import slugify, plural_or_singular_noun as ps
+from .utils import json_dumps_bytes, json_loads, slugify, plural_or_singular_noun as ps
 
 #
 # Orchestrates the interaction between the CLI, APIs and the processing bits
@@ -61,7 +65,16 @@ from .utils import slugify, plural_or_singular_noun as ps
 
 logger = logging.getLogger(__name__)
 requests_logger = logging.getLogger("urllib3")
-ch = logging.StreamHandler(io.TextIOWrapper(sys.stdout.buffer, encoding="utf-8"))
+if isinstance(sys.stdout, io.TextIOWrapper):
+    # log to stdout itself so that output stays in order with input() prompts,
+    # the utf-8 encoding is set in run() so that importing odmpy has no side effects
+    ch = logging.StreamHandler(sys.stdout)
+else:
+    ch = logging.StreamHandler(
+        io.TextIOWrapper(
+            sys.stdout.buffer, encoding="utf-8", line_buffering=True, write_through=True
+        )
+    )
 ch.setLevel(logging.DEBUG)
 logger.addHandler(ch)
 logger.setLevel(logging.INFO)
@@ -74,20 +87,102 @@ TAGS_ENDPOINT = "https://api.github.com/repos/ping/odmpy/tags"
 REPOSITORY_URL = "https://github.com/ping/odmpy"
 OLD_SETTINGS_FOLDER_DEFAULT = Path("./odmpy_settings")
 
+# bound once for command dispatch, see _DISPATCH and _run_libby()
+_CMD_LIBBY = OdmpyCommands.Libby
+_CMD_LIBBY_RETURN = OdmpyCommands.LibbyReturn
+_CMD_LIBBY_RENEW = OdmpyCommands.LibbyRenew
+_CMD_DOWNLOAD = OdmpyCommands.Download
+_CMD_RETURN = OdmpyCommands.Return
+_CMD_INFO = OdmpyCommands.Information
+_LIBBY_COMMANDS = frozenset({_CMD_LIBBY, _CMD_LIBBY_RETURN, _CMD_LIBBY_RENEW})
+
+# loan listing labels, in order of precedence
+_MEDIA_TYPE_EMOJIS = (
+    (LibbyMediaTypes.Magazine, "📰"),
+    (LibbyMediaTypes.EBook, "📕"),
+    (LibbyMediaTypes.Audiobook, "🎧"),
+)
+
+# loan formats handled in extract_loan_file()
+_EBOOK_FORMATS = frozenset(
+    {
+        LibbyFormats.EBookEPubAdobe,
+        LibbyFormats.EBookEPubOpen,
+        LibbyFormats.EBookOverdrive,
+        LibbyFormats.MagazineOverDrive,
+        LibbyFormats.EBookPDFAdobe,
+        LibbyFormats.EBookPDFOpen,
+    }
+)
+_OVERDRIVE_FORMATS = frozenset(
+    {LibbyFormats.EBookOverdrive, LibbyFormats.MagazineOverDrive}
+)
+_ACSM_FORMATS = frozenset({LibbyFormats.EBookEPubAdobe, LibbyFormats.EBookPDFAdobe})
+
+# book folder/file format fields, ReadingOrder is only available for libby
+_AVAILABLE_FIELDS_LIBBY: Tuple[str, ...] = DEFAULT_FORMAT_FIELDS
+_AVAILABLE_FIELDS_ODM: Tuple[str, ...] = tuple(
+    f for f in DEFAULT_FORMAT_FIELDS if f != "ReadingOrder"
+)
+_AVAILABLE_FIELDS_HELP_TEXT_LIBBY = "Available fields:\n  " + "\n  ".join(
+    [
+        "%%(Title)s : Title",
+        "%%(Author)s: Comma-separated Author names",
+        "%%(Series)s: Series",
+        "%%(ReadingOrder)s: Series Reading Order",
+        "%%(Edition)s: Edition",
+        "%%(ID)s: Title/Loan ID",
+    ]
+)
+_AVAILABLE_FIELDS_HELP_TEXT_ODM = _AVAILABLE_FIELDS_HELP_TEXT_LIBBY.replace(
+    "\n  %%(ReadingOrder)s: Series Reading Order", ""
+)
+
+# sessions shared by all requests made from this module, keyed by max_retries
+_session_cache: Dict[int, requests.Session] = {}
+# the version check gets its session from a background thread
+_session_cache_lock = threading.Lock()
+
+
+def _get_session(max_retries: int) -> requests.Session:
+    """
+    Returns a shared session so that connections are reused across requests.
+
+    :param max_retries:
+    :return:
+    """
+    with _session_cache_lock:
+        session = _session_cache.get(max_retries)
+        if not session:
+            session = _session_cache[max_retries] = init_session(max_retries)
+        return session
+
+
+@atexit.register
+def _close_sessions() -> None:
+    for session in _session_cache.values():
+        session.close()
+
 
-def check_version(timeout: int, max_retries: int) -> None:
-    sess = init_session(max_retries)
+def check_version(timeout: int, max_retries: int) -> Optional[str]:
+    """
+    Check for a newer release.
+
+    :param timeout:
+    :param max_retries:
+    :return: The new version if one is available
+    """
+    sess = _get_session(max_retries)
     # noinspection PyBroadException
     try:
         res = sess.get(TAGS_ENDPOINT, timeout=timeout)
         res.raise_for_status()
-        curr_version = res.json()[0].get("name", "")
+        curr_version = json_loads(res.content)[0].get("name", "")
         if curr_version and curr_version != __version__:
-            logger.warning(
-                f"⚠️  A new version {curr_version} is available at {REPOSITORY_URL}."
-            )
+            return curr_version
     except:  # noqa: E722, pylint: disable=bare-except
         pass
+    return None
 
 
 def add_common_libby_arguments(parser_libby: argparse.ArgumentParser) -> None:
@@ -198,33 +293,24 @@ def add_common_download_arguments(parser_dl: argparse.ArgumentParser) -> None:
         help="Don't create a book subfolder.",
     )
 
-    available_fields_help = [
-        "%%(Title)s : Title",
-        "%%(Author)s: Comma-separated Author names",
-        "%%(Series)s: Series",
-    ]
     if parser_dl.prog == "odmpy libby":
-        available_fields_help.append("%%(ReadingOrder)s: Series Reading Order")
-    available_fields_help.extend(["%%(Edition)s: Edition", "%%(ID)s: Title/Loan ID"])
-    available_fields_help_text = "Available fields:\n  " + "\n  ".join(
-        available_fields_help
-    )
-
-    available_fields = list(DEFAULT_FORMAT_FIELDS)
-    if parser_dl.prog != "odmpy libby":
-        available_fields.remove("ReadingOrder")
+        available_fields_help_text = _AVAILABLE_FIELDS_HELP_TEXT_LIBBY
+        available_fields = _AVAILABLE_FIELDS_LIBBY
+    else:
+        available_fields_help_text = _AVAILABLE_FIELDS_HELP_TEXT_ODM
+        available_fields = _AVAILABLE_FIELDS_ODM
 
     parser_dl.add_argument(
         "--bookfolderformat",
         dest="book_folder_format",
-        type=lambda v: valid_book_folder_file_format(v, tuple(available_fields)),
+        type=lambda v: valid_book_folder_file_format(v, available_fields),
         default="%(Title)s - %(Author)s",
         help=f'Book folder format string. Default "%%(Title)s - %%(Author)s".\n{available_fields_help_text}',
     )
     parser_dl.add_argument(
         "--bookfileformat",
         dest="book_file_format",
-        type=lambda v: valid_book_folder_file_format(v, tuple(available_fields)),
+        type=lambda v: valid_book_folder_file_format(v, available_fields),
         default="%(Title)s - %(Author)s",
         help=(
             'Book file format string (without extension). Default "%%(Title)s - %%(Author)s".\n'
@@ -289,6 +375,22 @@ def add_common_download_arguments(parser_dl: argparse.ArgumentParser) -> None:
         action="store_true",
         help="Generate a meta json file (for debugging).",
     )
+    parser_dl.add_argument(
+        "--parallel",
+        dest="download_parallelism",
+        type=positive_int,
+        default=1,
+        help="Number of audiobook part files to download\nconcurrently.",
+    )
+    parser_dl.add_argument(
+        "--forceremux",
+        dest="force_remux",
+        action="store_true",
+        help=(
+            "Always remux downloaded audiobook part files with"
+            "\nffmpeg, even if they do not appear to need it."
+        ),
+    )
     parser_dl.add_argument(
         "--hideprogress",
         dest="hide_progress",
@@ -301,25 +403,23 @@ def extract_bundled_contents(
     libby_client: LibbyClient,
     overdrive_client: OverDriveClient,
     selected_loan: Dict,
-    cards: List[Dict],
+    cards_by_id: Dict[str, Dict],
     args: argparse.Namespace,
 ):
     format_id = libby_client.get_loan_format(selected_loan)
     format_info: Dict = next(
-        iter([f for f in selected_loan.get("formats", []) if f["id"] == format_id]),
-        {},
-    )
-    card: Dict = next(
-        iter([c for c in cards if c["cardId"] == selected_loan["cardId"]]), {}
+        (f for f in selected_loan.get("formats", []) if f["id"] == format_id), {}
     )
+    card: Dict = cards_by_id.get(selected_loan["cardId"], {})
     if format_info.get("isBundleParent") and format_info.get("bundledContent", []):
         bundled_contents_ids = list(
-            set([bc["titleId"] for bc in format_info["bundledContent"]])
+            dict.fromkeys(bc["titleId"] for bc in format_info["bundledContent"])
         )
-        for bundled_content_id in bundled_contents_ids:
-            bundled_media = overdrive_client.library_media(
-                card["advantageKey"], bundled_content_id
-            )
+        # the downloads stay sequential because they report progress on the console
+        bundled_medias = overdrive_client.library_media_concurrent(
+            card["advantageKey"], bundled_contents_ids
+        )
+        for bundled_media in bundled_medias:
             if not libby_client.is_downloadable_ebook_loan(bundled_media):
                 continue
             try:
@@ -360,11 +460,6 @@ def extract_loan_file(
             logger.error(colored(err_msg, "red"))
         return None
 
-    file_ext = "odm"
-    file_name = f'{selected_loan["title"]} {selected_loan["id"]}'
-    loan_file_path = Path(
-        args.download_dir, f"{slugify(file_name, allow_unicode=True)}.{file_ext}"
-    )
     if (
         args.libby_direct
         and libby_client.has_format(selected_loan, LibbyFormats.EBookOverdrive)
@@ -380,21 +475,14 @@ def extract_loan_file(
     rosters: List[Dict] = []
     # pre-extract openbook first so that we can use it to create the book folder
     # with the creator names (needed to place the cover.jpg download)
-    if format_id in (LibbyFormats.EBookOverdrive, LibbyFormats.MagazineOverDrive):
+    if format_id in _OVERDRIVE_FORMATS:
         _, openbook, rosters = libby_client.process_ebook(selected_loan)
 
     cover_path = None
-    if format_id in (
-        LibbyFormats.EBookEPubAdobe,
-        LibbyFormats.EBookEPubOpen,
-        LibbyFormats.EBookOverdrive,
-        LibbyFormats.MagazineOverDrive,
-        LibbyFormats.EBookPDFAdobe,
-        LibbyFormats.EBookPDFOpen,
-    ):
+    if format_id in _EBOOK_FORMATS:
         file_ext = (
             "acsm"
-            if format_id in (LibbyFormats.EBookEPubAdobe, LibbyFormats.EBookPDFAdobe)
+            if format_id in _ACSM_FORMATS
             else "pdf"
             if format_id == LibbyFormats.EBookPDFOpen
             else "epub"
@@ -417,28 +505,26 @@ def extract_loan_file(
             logger=logger,
         )
         loan_file_path = book_file_name.with_suffix(f".{file_ext}")
-        if (
-            format_id
-            in (
-                LibbyFormats.EBookOverdrive,
-                LibbyFormats.MagazineOverDrive,
-            )
-            and not loan_file_path.exists()
-        ):
+    else:
+        file_ext = "odm"
+        file_name = f'{selected_loan["title"]} {selected_loan["id"]}'
+        loan_file_path = Path(
+            args.download_dir, f"{slugify(file_name, allow_unicode=True)}.{file_ext}"
+        )
+
+    # don't re-download odm if it already exists so that we don't
+    # needlessly use up the fulfillment limits
+    if not loan_file_path.exists():
+        if format_id in _OVERDRIVE_FORMATS:
             # we need the cover for embedding
             cover_path, _ = generate_cover(
                 book_folder=book_folder,
                 cover_url=get_best_cover_url(selected_loan),
-                session=init_session(args.retries),
+                session=_get_session(args.retries),
                 timeout=args.timeout,
                 logger=logger,
                 force_square=False,
             )
-
-    # don't re-download odm if it already exists so that we don't
-    # needlessly use up the fulfillment limits
-    if not loan_file_path.exists():
-        if format_id in (LibbyFormats.EBookOverdrive, LibbyFormats.MagazineOverDrive):
             process_ebook_loan(
                 loan=selected_loan,
                 cover_path=cover_path,
@@ -451,16 +537,17 @@ def extract_loan_file(
         else:
             # formats: odm, acsm, open-epub, open-pdf
             try:
-                odm_res_content = libby_client.fulfill_loan_file(
-                    selected_loan["id"], selected_loan["cardId"], format_id
+                libby_client.fulfill_loan_file_to_path(
+                    selected_loan["id"],
+                    selected_loan["cardId"],
+                    format_id,
+                    loan_file_path,
+                )
+                logger.info(
+                    'Downloaded %s to "%s"',
+                    file_ext,
+                    colored(str(loan_file_path), "magenta"),
                 )
-                with loan_file_path.open("wb") as f:
-                    f.write(odm_res_content)
-                    logger.info(
-                        'Downloaded %s to "%s"',
-                        file_ext,
-                        colored(str(loan_file_path), "magenta"),
-                    )
             except ClientError as ce:
                 if ce.http_status == 400 and libby_client.is_downloadable_ebook_loan(
                     selected_loan
@@ -481,75 +568,522 @@ def extract_loan_file(
             colored(str(loan_file_path), "magenta"),
         )
 
-    if cover_path and cover_path.exists() and not args.always_keep_cover:
+    if cover_path and not args.always_keep_cover:
         # clean up
-        cover_path.unlink()
+        try:
+            cover_path.unlink()
+        except FileNotFoundError:
+            pass
 
     return loan_file_path
 
 
-def run(custom_args: Optional[List[str]] = None, be_quiet: bool = False) -> None:
+def _download_libby_direct(
+    libby_client: LibbyClient,
+    overdrive_client: OverDriveClient,
+    selected_loans: List[Dict],
+    cards_by_id: Dict[str, Dict],
+    args: argparse.Namespace,
+    logger: logging.Logger,
+) -> None:
     """
+    Download the selected loans directly, i.e. without the odm/acsm loan file.
 
-    :param custom_args: Used by unittests
-    :param be_quiet: Used by unittests
+    :param libby_client:
+    :param overdrive_client:
+    :param selected_loans:
+    :param cards_by_id:
+    :param args:
+    :param logger:
     :return:
     """
-    parser = argparse.ArgumentParser(
-        prog="odmpy",
-        description="Manage your OverDrive loans",
-        epilog=(
-            f"Version {__version__}. "
-            f"[Python {sys.version_info.major}.{sys.version_info.minor}.{sys.version_info.micro}-{sys.platform}] "
-            f"Source at {REPOSITORY_URL}"
-        ),
-        fromfile_prefix_chars="@",
+    for selected_loan in selected_loans:
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(
+                'Opening %s "%s"...',
+                selected_loan.get("type", {}).get("id"),
+                colored(selected_loan["title"], "blue"),
+            )
+        media_types = libby_client.get_downloadable_media_types(selected_loan)
+        if LibbyMediaTypes.Audiobook in media_types:
+            openbook, toc = libby_client.process_audiobook(selected_loan)
+            process_audiobook_loan(
+                selected_loan,
+                openbook,
+                toc,
+                libby_client.libby_session,
+                args,
+                logger,
+                libby_client.cache_folder,
+            )
+            extract_bundled_contents(
+                libby_client,
+                overdrive_client,
+                selected_loan,
+                cards_by_id,
+                args,
+            )
+            continue
+        elif (
+            LibbyMediaTypes.EBook in media_types
+            or LibbyMediaTypes.Magazine in media_types
+        ):
+            extract_loan_file(libby_client, selected_loan, args)
+            continue
+
+
+def _run_libby(args: argparse.Namespace, logger: logging.Logger) -> None:
+    """
+    Libby-based commands: libby, libbyreturn, libbyrenew
+
+    :param args:
+    :param logger:
+    :return:
+    """
+    logger.info("%s Interactive Client for Libby", colored("odmpy", attrs=["bold"]))
+    logger.info("-" * 70)
+
+    token = os.environ.get("LIBBY_TOKEN")
+    if token:
+        # use token auth if available
+        libby_client = LibbyClient(
+            identity_token=token,
+            max_retries=args.retries,
+            timeout=args.timeout,
+            logger=logger,
+            pool_maxsize=max(32, args.download_parallelism),
+        )
+    else:
+        libby_client = LibbyClient(
+            settings_folder=args.settings_folder,
+            max_retries=args.retries,
+            timeout=args.timeout,
+            logger=logger,
+            pool_maxsize=max(32, args.download_parallelism),
+        )
+
+    overdrive_client = OverDriveClient(
+        user_agent=libby_client.user_agent,
+        timeout=args.timeout,
+        retry=args.retries,
     )
-    parser.add_argument(
-        "--version",
-        action="version",
-        version=(
-            f"%(prog)s {__version__} "
-            f"[Python {sys.version_info.major}.{sys.version_info.minor}.{sys.version_info.micro}-{sys.platform}]"
+
+    if args.command_name == _CMD_LIBBY and args.reset_settings:
+        libby_client.clear_settings()
+        logger.info("Cleared settings.")
+        return
+
+    if args.command_name == _CMD_LIBBY and args.check_signed_in:
+        if not libby_client.get_token():
+            raise LibbyNotConfiguredError("Libby has not been setup.")
+        if not libby_client.is_logged_in():
+            raise LibbyNotConfiguredError("Libby is not signed-in.")
+        logger.info("Libby is signed-in with token:\n%s", libby_client.get_token())
+        return
+
+    # detect if non-interactive command options are selected before setup
+    if not libby_client.get_token():
+        if any(
+            getattr(args, opt_name, None) for opt_name in OdmpyNoninteractiveOptions
+        ):
+            raise OdmpyRuntimeError(
+                'Libby has not been setup. Please run "odmpy libby" first.'
+            )
+
+    if not libby_client.get_token():
+        instructions = (
+            "A Libby setup code is needed to allow odmpy to interact with Libby.\n"
+            "To get a Libby code, see https://help.libbyapp.com/en-us/6070.htm\n"
+        )
+        logger.info(instructions)
+        while True:
+            sync_code = input("Enter the 8-digit Libby code and press enter: ").strip()
+            if not sync_code:
+                return
+            if not LibbyClient.is_valid_sync_code(sync_code):
+                logger.warning("Invalid code: %s", colored(sync_code, "red"))
+                continue
+            break
+
+        try:
+            libby_client.get_chip()
+            libby_client.clone_by_code(sync_code)
+            if not libby_client.is_logged_in():
+                libby_client.clear_settings()
+                raise OdmpyRuntimeError(
+                    "Could not log in with code.\n"
+                    "Make sure that you have entered the right code and within the time limit.\n"
+                    "You also need to have at least 1 registered library card."
+                )
+            logger.info("Login successful.\n")
+        except ClientError as ce:
+            libby_client.clear_settings()
+            raise OdmpyRuntimeError(
+                "Could not log in with code.\n"
+                "Make sure that you have entered the right code and within the time limit."
+            ) from ce
+
+    synced_state = libby_client.sync()
+    cards_by_id: Dict[str, Dict] = {
+        c["cardId"]: c for c in synced_state.get("cards", [])
+    }
+    # sort by checkout date so that recent most is at the bottom
+    include_media_types = set()
+    if not args.exclude_audiobooks:
+        include_media_types.add(LibbyMediaTypes.Audiobook)
+    if args.include_ebooks:
+        include_media_types.add(LibbyMediaTypes.EBook)
+    if args.include_magazines:
+        include_media_types.add(LibbyMediaTypes.Magazine)
+    libby_loans = sorted(
+        (
+            book
+            for book in synced_state.get("loans", [])
+            if include_media_types & libby_client.get_downloadable_media_types(book)
         ),
+        key=itemgetter("checkoutDate"),
     )
-    parser.add_argument(
-        "-v",
-        "--verbose",
-        dest="verbose",
-        action="store_true",
-        help="Enable more verbose messages for debugging.",
-    )
-    parser.add_argument(
-        "-t",
-        "--timeout",
-        dest="timeout",
-        type=int,
-        default=10,
-        help="Timeout (seconds) for network requests. Default 10.",
-    )
-    parser.add_argument(
-        "-r",
-        "--retry",
-        dest="retries",
-        type=int,
-        default=1,
-        help="Number of retries if a network request fails. Default 1.",
-    )
-    parser.add_argument(
-        "--noversioncheck",
-        dest="dont_check_version",
-        default=False,
-        action="store_true",
-        help="Do not check if newer version is available.",
+
+    if args.command_name == _CMD_LIBBY and args.export_loans_path:
+        logger.info(
+            "Non-interactive mode. Exporting loans json to %s...",
+            colored(args.export_loans_path, "magenta"),
+        )
+        with open(args.export_loans_path, "wb") as f:
+            # write each loan separately so that the whole list is never
+            # serialised into memory at once
+            f.write(b"[")
+            for i, loan in enumerate(libby_loans):
+                if i:
+                    f.write(b",")
+                f.write(json_dumps_bytes(loan))
+            f.write(b"]")
+            logger.info(
+                'Saved loans as "%s"',
+                colored(args.export_loans_path, "magenta", attrs=["bold"]),
+            )
+        return
+
+    if args.command_name == _CMD_LIBBY_RENEW:
+        libby_loans = [loan for loan in libby_loans if libby_client.is_renewable(loan)]
+        if not libby_loans:
+            logger.info("No renewable loans found.")
+            return
+
+    if not libby_loans:
+        logger.info("No downloadable loans found.")
+        return
+
+    if args.command_name == _CMD_LIBBY and (
+        args.selected_loans_indices or args.download_latest_n or args.selected_loans_ids
+    ):
+        # Non-interactive selection
+        selected_loans_indices: List[int] = []
+        total_loans_count = len(libby_loans)
+        if args.selected_loans_indices:
+            selected_loans_indices.extend(
+                j for j in args.selected_loans_indices if j <= total_loans_count
+            )
+            logger.info(
+                "Non-interactive mode. Downloading selected %s %s...",
+                ps(len(selected_loans_indices), "loan"),
+                colored(
+                    ", ".join(map(str, selected_loans_indices)),
+                    "blue",
+                    attrs=["bold"],
+                ),
+            )
+        if args.download_latest_n:
+            logger.info(
+                "Non-interactive mode. Downloading latest %s %s...",
+                colored(str(args.download_latest_n), "blue"),
+                ps(args.download_latest_n, "loan"),
+            )
+            selected_loans_indices.extend(
+                range(
+                    max(1, total_loans_count - args.download_latest_n + 1),
+                    total_loans_count + 1,
+                )
+            )
+        if args.selected_loans_ids:
+            selected_loans_ids = [str(i) for i in args.selected_loans_ids]
+            logger.info(
+                "Non-interactive mode. Downloading loans with %s %s...",
+                ps(len(selected_loans_ids), "ID"),
+                ", ".join(colored(i, "blue") for i in selected_loans_ids),
+            )
+            for n, loan in enumerate(libby_loans, start=1):
+                if loan["id"] in selected_loans_ids:
+                    selected_loans_indices.append(n)
+        selected_loans_indices = sorted(set(selected_loans_indices))
+        selected_loans: List[Dict] = [
+            libby_loans[j - 1] for j in selected_loans_indices
+        ]
+        if args.libby_direct:
+            _download_libby_direct(
+                libby_client,
+                overdrive_client,
+                selected_loans,
+                cards_by_id,
+                args,
+                logger,
+            )
+            return
+
+        for selected_loan in selected_loans:
+            if logger.isEnabledFor(logging.INFO):
+                logger.info(
+                    'Opening %s "%s"...',
+                    selected_loan.get("type", {}).get("id"),
+                    colored(selected_loan["title"], "blue"),
+                )
+            media_types = libby_client.get_downloadable_media_types(selected_loan)
+            if LibbyMediaTypes.Audiobook in media_types:
+                process_odm(
+                    extract_loan_file(libby_client, selected_loan, args),
+                    selected_loan,
+                    args,
+                    logger,
+                    cleanup_odm_license=not args.keepodm,
+                )
+                extract_bundled_contents(
+                    libby_client,
+                    overdrive_client,
+                    selected_loan,
+                    cards_by_id,
+                    args,
+                )
+
+            elif (
+                LibbyMediaTypes.EBook in media_types
+                or LibbyMediaTypes.Magazine in media_types
+            ):
+                extract_loan_file(libby_client, selected_loan, args)
+                continue
+
+        return  # non-interactive libby downloads
+
+    # Interactive mode
+    holds_by_loan: Dict[Tuple[str, str], Dict] = {
+        (h["cardId"], h["id"]): h for h in synced_state.get("holds", [])
+    }
+    logger.info(
+        "Found %s %s.",
+        colored(str(len(libby_loans)), "blue"),
+        ps(len(libby_loans), "loan"),
     )
+    # only label the media type when more than audiobooks are listed
+    show_media_type = args.include_ebooks or args.include_magazines
+    if logger.isEnabledFor(logging.INFO):
+        for index, loan in enumerate(libby_loans, start=1):
+            expiry_date = LibbyClient.parse_datetime(loan["expireDate"])
+            hold = holds_by_loan.get((loan["cardId"], loan["id"]))
+            hold_date = LibbyClient.parse_datetime(hold["placedDate"]) if hold else None
+            is_renewable = libby_client.is_renewable(loan)
+            media_types = (
+                libby_client.get_downloadable_media_types(loan) & include_media_types
+            )
+            media_type_emoji = (
+                next(
+                    (emoji for t, emoji in _MEDIA_TYPE_EMOJIS if t in media_types),
+                    "",
+                )
+                if show_media_type
+                else ""
+            )
 
-    subparsers = parser.add_subparsers(
-        title="Available commands",
-        dest="command_name",
-        help="To get more help, use the -h option with the command.",
+            logger.info(
+                "%s: %-55s  %s %-25s  \n    * %s  %s%s",
+                colored(f"{index:2d}", attrs=["bold"]),
+                colored(loan["title"], attrs=["bold"]),
+                media_type_emoji,
+                loan["firstCreatorName"]
+                if loan.get("firstCreatorName")
+                else loan.get("edition", ""),
+                f"Expires: {colored(f'{expiry_date:%Y-%m-%d}','blue' if is_renewable else None)}",
+                cards_by_id[loan["cardId"]]["library"]["name"],
+                ""
+                if not is_renewable
+                else (
+                    f'\n    * {loan.get("availableCopies", 0)} '
+                    f'{ps(loan.get("availableCopies", 0), "copy", "copies")} available'
+                )
+                + (f" (hold placed: {hold_date:%Y-%m-%d})" if hold else ""),
+            )
+    loan_choices: List[int] = []
+
+    # Loans display and user choice prompt
+    libby_mode = "download"
+    if args.command_name == _CMD_LIBBY_RETURN:
+        libby_mode = "return"
+    elif args.command_name == _CMD_LIBBY_RENEW:
+        libby_mode = "renew"
+    while True:
+        user_loan_choice_input = input(
+            f'\n{colored(libby_mode.title(), "magenta", attrs=["bold"])}. '
+            f'Choose from {colored(f"1-{len(libby_loans)}", attrs=["bold"])} '
+            "(separate choices with a space or leave blank to quit), \n"
+            "then press enter: "
+        ).strip()
+        if not user_loan_choice_input:
+            # abort choice if user enters blank
+            break
+
+        loan_choices_input = set(user_loan_choice_input.split(" "))
+        invalid_choice = next(
+            (
+                c
+                for c in loan_choices_input
+                if not (c.isdigit() and 0 < int(c) <= len(libby_loans))
+            ),
+            None,
+        )
+        if invalid_choice is not None:
+            logger.warning(f"Invalid choice: {invalid_choice}")
+            continue
+        loan_choices = sorted({int(c) for c in loan_choices_input})
+        break
+
+    if not loan_choices:
+        # abort if no choices made
+        return
+    selected_loans = [libby_loans[c - 1] for c in loan_choices]
+
+    if args.command_name == _CMD_LIBBY_RETURN:
+        # do returns
+        for selected_loan in selected_loans:
+            logger.info(
+                'Returning loan "%s"...',
+                colored(selected_loan["title"], "blue"),
+            )
+            libby_client.return_loan(selected_loan)
+            logger.info(
+                'Returned "%s".',
+                colored(selected_loan["title"], "blue"),
+            )
+        return  # end libby return command
+
+    if args.command_name == _CMD_LIBBY_RENEW:
+        # do renewals
+        for selected_loan in selected_loans:
+            logger.info(
+                'Renewing loan "%s"...',
+                colored(selected_loan["title"], "blue"),
+            )
+            try:
+                _ = libby_client.renew_loan(selected_loan)
+                logger.info(
+                    'Renewed "%s".',
+                    colored(selected_loan["title"], "blue"),
+                )
+            except ClientBadRequestError as badreq_err:
+                logger.warning(
+                    'Error encountered while renewing "%s": %s',
+                    selected_loan["title"],
+                    colored(badreq_err.msg, "red"),
+                )
+                if (
+                    selected_loan.get("availableCopies", 0) == 0
+                    and (selected_loan["cardId"], selected_loan["id"])
+                    not in holds_by_loan
+                ):
+                    # offer to make a hold
+                    make_hold = input(
+                        "Do you wish to place a hold instead? (y/n): "
+                    ).strip()
+                    if make_hold == "y":
+                        hold = libby_client.create_hold(
+                            selected_loan["id"], selected_loan["cardId"]
+                        )
+                        logger.info(
+                            "Hold successfully created for %s. You are #%s in line. %s %s in use. Available in ~%s %s.",
+                            colored(hold["title"], attrs=["bold"]),
+                            hold.get("holdListPosition", 0),
+                            hold.get("ownedCopies"),
+                            ps(hold.get("ownedCopies", 0), "copy", "copies"),
+                            hold.get("estimatedWaitDays", 0),
+                            ps(hold.get("estimatedWaitDays", 0), "day"),
+                        )
+
+        return  # end libby renew command
+
+    if args.command_name == _CMD_LIBBY:
+        # do downloads
+        if args.libby_direct:
+            _download_libby_direct(
+                libby_client,
+                overdrive_client,
+                selected_loans,
+                cards_by_id,
+                args,
+                logger,
+            )
+            return
+
+        for selected_loan in selected_loans:
+            if logger.isEnabledFor(logging.INFO):
+                logger.info(
+                    'Opening %s "%s"...',
+                    selected_loan.get("type", {}).get("id"),
+                    colored(selected_loan["title"], "blue"),
+                )
+            media_types = libby_client.get_downloadable_media_types(selected_loan)
+            if LibbyMediaTypes.Audiobook in media_types:
+                process_odm(
+                    extract_loan_file(libby_client, selected_loan, args),
+                    selected_loan,
+                    args,
+                    logger,
+                    cleanup_odm_license=not args.keepodm,
+                )
+                extract_bundled_contents(
+                    libby_client,
+                    overdrive_client,
+                    selected_loan,
+                    cards_by_id,
+                    args,
+                )
+                continue
+            elif (
+                LibbyMediaTypes.EBook in media_types
+                or LibbyMediaTypes.Magazine in media_types
+            ):
+                extract_loan_file(libby_client, selected_loan, args)
+                continue
+        return
+
+
+def _run_odm_return(args: argparse.Namespace, logger: logging.Logger) -> None:
+    process_odm_return(args, logger)
+
+
+def _run_odm_download(args: argparse.Namespace, logger: logging.Logger) -> None:
+    logger.info(
+        'Opening odm "%s"...',
+        colored(args.odm_file, "blue"),
     )
+    process_odm(Path(args.odm_file), {}, args, logger)
 
+
+def _run_odm_info(args: argparse.Namespace, logger: logging.Logger) -> None:
+    process_odm(Path(args.odm_file), {}, args, logger)
+
+
+# command handlers, looked up by args.command_name in run()
+_DISPATCH: Dict[str, Callable[[argparse.Namespace, logging.Logger], None]] = {
+    _CMD_LIBBY: _run_libby,
+    _CMD_LIBBY_RETURN: _run_libby,
+    _CMD_LIBBY_RENEW: _run_libby,
+    # Legacy ODM-based commands
+    _CMD_RETURN: _run_odm_return,
+    _CMD_DOWNLOAD: _run_odm_download,
+    _CMD_INFO: _run_odm_info,
+}
+
+
+def _add_libby_parser(
+    subparsers: "argparse._SubParsersAction[argparse.ArgumentParser]",
+) -> None:
     # libby download parser
     parser_libby = subparsers.add_parser(
         OdmpyCommands.Libby,
@@ -632,6 +1166,10 @@ def run(custom_args: Optional[List[str]] = None, be_quiet: bool = False) -> None
         help="Debug switch for use during development. Please do not use.",
     )
 
+
+def _add_libby_return_parser(
+    subparsers: "argparse._SubParsersAction[argparse.ArgumentParser]",
+) -> None:
     # libby return parser
     parser_libby_return = subparsers.add_parser(
         OdmpyCommands.LibbyReturn,
@@ -641,6 +1179,10 @@ def run(custom_args: Optional[List[str]] = None, be_quiet: bool = False) -> None
     )
     add_common_libby_arguments(parser_libby_return)
 
+
+def _add_libby_renew_parser(
+    subparsers: "argparse._SubParsersAction[argparse.ArgumentParser]",
+) -> None:
     # libby renew parser
     parser_libby_renew = subparsers.add_parser(
         OdmpyCommands.LibbyRenew,
@@ -650,6 +1192,10 @@ def run(custom_args: Optional[List[str]] = None, be_quiet: bool = False) -> None
     )
     add_common_libby_arguments(parser_libby_renew)
 
+
+def _add_odm_download_parser(
+    subparsers: "argparse._SubParsersAction[argparse.ArgumentParser]",
+) -> None:
     # odm download parser
     parser_dl = subparsers.add_parser(
         OdmpyCommands.Download,
@@ -660,6 +1206,10 @@ def run(custom_args: Optional[List[str]] = None, be_quiet: bool = False) -> None
     parser_dl.add_argument("odm_file", type=str, help="ODM file path.")
     add_common_download_arguments(parser_dl)
 
+
+def _add_odm_return_parser(
+    subparsers: "argparse._SubParsersAction[argparse.ArgumentParser]",
+) -> None:
     # odm return parser
     parser_ret = subparsers.add_parser(
         OdmpyCommands.Return,
@@ -668,6 +1218,10 @@ def run(custom_args: Optional[List[str]] = None, be_quiet: bool = False) -> None
     )
     parser_ret.add_argument("odm_file", type=str, help="ODM file path.")
 
+
+def _add_odm_info_parser(
+    subparsers: "argparse._SubParsersAction[argparse.ArgumentParser]",
+) -> None:
     # odm info parser
     parser_info = subparsers.add_parser(
         OdmpyCommands.Information,
@@ -684,7 +1238,124 @@ def run(custom_args: Optional[List[str]] = None, be_quiet: bool = False) -> None
     )
     parser_info.add_argument("odm_file", type=str, help="ODM file path.")
 
-    args = parser.parse_args(custom_args)
+
+# command parsers are only built as needed, see run()
+_SUBPARSER_BUILDERS: Dict[
+    str,
+    Callable[["argparse._SubParsersAction[argparse.ArgumentParser]"], None],
+] = {
+    _CMD_LIBBY: _add_libby_parser,
+    _CMD_LIBBY_RETURN: _add_libby_return_parser,
+    _CMD_LIBBY_RENEW: _add_libby_renew_parser,
+    _CMD_DOWNLOAD: _add_odm_download_parser,
+    _CMD_RETURN: _add_odm_return_parser,
+    _CMD_INFO: _add_odm_info_parser,
+}
+
+
+def _build_parser(command_names: Iterable[str]) -> argparse.ArgumentParser:
+    """
+    Build the argument parser with the subparsers for the specified commands.
+
+    :param command_names: Keys of `_SUBPARSER_BUILDERS`
+    :return:
+    """
+    parser = argparse.ArgumentParser(
+        prog="odmpy",
+        description="Manage your OverDrive loans",
+        epilog=(
+            f"Version {__version__}. "
+            f"[Python {sys.version_info.major}.{sys.version_info.minor}.{sys.version_info.micro}-{sys.platform}] "
+            f"Source at {REPOSITORY_URL}"
+        ),
+        fromfile_prefix_chars="@",
+    )
+    parser.add_argument(
+        "--version",
+        action="version",
+        version=(
+            f"%(prog)s {__version__} "
+            f"[Python {sys.version_info.major}.{sys.version_info.minor}.{sys.version_info.micro}-{sys.platform}]"
+        ),
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        dest="verbose",
+        action="store_true",
+        help="Enable more verbose messages for debugging.",
+    )
+    parser.add_argument(
+        "-t",
+        "--timeout",
+        dest="timeout",
+        type=int,
+        default=10,
+        help="Timeout (seconds) for network requests. Default 10.",
+    )
+    parser.add_argument(
+        "-r",
+        "--retry",
+        dest="retries",
+        type=int,
+        default=1,
+        help="Number of retries if a network request fails. Default 1.",
+    )
+    parser.add_argument(
+        "--noversioncheck",
+        dest="dont_check_version",
+        default=False,
+        action="store_true",
+        help="Do not check if newer version is available.",
+    )
+
+    subparsers = parser.add_subparsers(
+        title="Available commands",
+        dest="command_name",
+        help="To get more help, use the -h option with the command.",
+    )
+    for command_name in command_names:
+        _SUBPARSER_BUILDERS[command_name](subparsers)
+    return parser
+
+
+def run(custom_args: Optional[List[str]] = None, be_quiet: bool = False) -> None:
+    """
+
+    :param custom_args: Used by unittests
+    :param be_quiet: Used by unittests
+    :return:
+    """
+    if isinstance(sys.stdout, io.TextIOWrapper):
+        # before anything is logged, for titles with non-ascii characters
+        sys.stdout.reconfigure(encoding="utf-8")
+
+    cli_args = sys.argv[1:] if custom_args is None else custom_args
+    command_name = next((a for a in cli_args if a in _SUBPARSER_BUILDERS), None)
+    args: Optional[argparse.Namespace] = None
+    if command_name and not any(
+        a in ("-h", "--help") or a.startswith("@") for a in cli_args
+    ):
+        # only the parser for the command being run is needed
+        try:
+            # errors are reported by the full parser below instead,
+            # so that the usage lists all the commands
+            with contextlib.redirect_stderr(io.StringIO()):
+                args = _build_parser([command_name]).parse_args(custom_args)
+        except SystemExit as exit_err:
+            if not exit_err.code:
+                raise
+    if args is None:
+        args = _build_parser(_SUBPARSER_BUILDERS).parse_args(custom_args)
+    # options that not all commands have, so that they can be checked directly
+    for opt_name, opt_default in (
+        ("download_dir", None),
+        ("settings_folder", None),
+        ("export_loans_path", None),
+        ("obsolete_retries", 0),
+        ("download_parallelism", 1),
+    ):
+        setattr(args, opt_name, getattr(args, opt_name, opt_default))
 
     if be_quiet:
         # in test mode
@@ -694,7 +1365,7 @@ def run(custom_args: Optional[List[str]] = None, be_quiet: bool = False) -> None
         requests_logger.setLevel(logging.DEBUG)
         HTTPConnection.debuglevel = 1
 
-    if hasattr(args, "download_dir") and args.download_dir:
+    if args.download_dir:
         download_dir = Path(args.download_dir)
         if not download_dir.exists():
             # prevents FileNotFoundError when using libby odm-based downloads
@@ -703,7 +1374,7 @@ def run(custom_args: Optional[List[str]] = None, be_quiet: bool = False) -> None
             download_dir.mkdir(parents=True, exist_ok=True)
         args.download_dir = str(download_dir.expanduser())
 
-    if hasattr(args, "settings_folder"):
+    if args.command_name in _LIBBY_COMMANDS:
         default_config_folder = (
             Path(
                 os.environ.get("APPDATA")
@@ -721,7 +1392,7 @@ def run(custom_args: Optional[List[str]] = None, be_quiet: bool = False) -> None
         else:
             args.settings_folder = str(default_config_folder)
 
-    if hasattr(args, "export_loans_path") and args.export_loans_path:
+    if args.export_loans_path:
         args.export_loans_path = str(Path(args.export_loans_path).expanduser())
 
     # suppress warnings
@@ -729,10 +1400,21 @@ def run(custom_args: Optional[List[str]] = None, be_quiet: bool = False) -> None
         logging.WARNING if logger.level == logging.DEBUG else logging.ERROR
     )
 
+    version_check_thread: Optional[threading.Thread] = None
+    new_versions: List[str] = []
     if not args.dont_check_version:
-        check_version(args.timeout, args.retries)
-
-    if hasattr(args, "obsolete_retries") and args.obsolete_retries:
+        # don't hold up the command for the version check,
+        # the result is only reported after the command so that it
+        # doesn't get mixed into the command's output or prompts
+        def _check_version() -> None:
+            new_version = check_version(args.timeout, args.retries)
+            if new_version:
+                new_versions.append(new_version)
+
+        version_check_thread = threading.Thread(target=_check_version, daemon=True)
+        version_check_thread.start()
+
+    if args.obsolete_retries:
         # retire --retry on the subcommands, after v0.6.7
         logger.warning(
             f"{'*' * 60}\n⚠️  The %s option for the %s command is no longer valid, and\n"
@@ -747,525 +1429,30 @@ def run(custom_args: Optional[List[str]] = None, be_quiet: bool = False) -> None
         )
         time.sleep(3)
 
-    try:
-        # Libby-based commands
-        if args.command_name in (
-            OdmpyCommands.Libby,
-            OdmpyCommands.LibbyReturn,
-            OdmpyCommands.LibbyRenew,
-        ):
-            logger.info(
-                "%s Interactive Client for Libby", colored("odmpy", attrs=["bold"])
-            )
-            logger.info("-" * 70)
-
-            token = os.environ.get("LIBBY_TOKEN")
-            if token:
-                # use token auth if available
-                libby_client = LibbyClient(
-                    identity_token=token,
-                    max_retries=args.retries,
-                    timeout=args.timeout,
-                    logger=logger,
-                )
-            else:
-                libby_client = LibbyClient(
-                    settings_folder=args.settings_folder,
-                    max_retries=args.retries,
-                    timeout=args.timeout,
-                    logger=logger,
-                )
-
-            overdrive_client = OverDriveClient(
-                user_agent=libby_client.user_agent,
-                timeout=args.timeout,
-                retry=args.retries,
-            )
-
-            if args.command_name == OdmpyCommands.Libby and args.reset_settings:
-                libby_client.clear_settings()
-                logger.info("Cleared settings.")
-                return
-
-            if args.command_name == OdmpyCommands.Libby and args.check_signed_in:
-                if not libby_client.get_token():
-                    raise LibbyNotConfiguredError("Libby has not been setup.")
-                if not libby_client.is_logged_in():
-                    raise LibbyNotConfiguredError("Libby is not signed-in.")
-                logger.info(
-                    "Libby is signed-in with token:\n%s", libby_client.get_token()
-                )
-                return
-
-            # detect if non-interactive command options are selected before setup
-            if not libby_client.get_token():
-                if [
-                    opt_name
-                    for opt_name in OdmpyNoninteractiveOptions
-                    if hasattr(args, opt_name) and getattr(args, opt_name)
-                ]:
-                    raise OdmpyRuntimeError(
-                        'Libby has not been setup. Please run "odmpy libby" first.'
-                    )
-
-            if not libby_client.get_token():
-                instructions = (
-                    "A Libby setup code is needed to allow odmpy to interact with Libby.\n"
-                    "To get a Libby code, see https://help.libbyapp.com/en-us/6070.htm\n"
-                )
-                logger.info(instructions)
-                while True:
-                    sync_code = input(
-                        "Enter the 8-digit Libby code and press enter: "
-                    ).strip()
-                    if not sync_code:
-                        return
-                    if not LibbyClient.is_valid_sync_code(sync_code):
-                        logger.warning("Invalid code: %s", colored(sync_code, "red"))
-                        continue
-                    break
-
-                try:
-                    libby_client.get_chip()
-                    libby_client.clone_by_code(sync_code)
-                    if not libby_client.is_logged_in():
-                        libby_client.clear_settings()
-                        raise OdmpyRuntimeError(
-                            "Could not log in with code.\n"
-                            "Make sure that you have entered the right code and within the time limit.\n"
-                            "You also need to have at least 1 registered library card."
-                        )
-                    logger.info("Login successful.\n")
-                except ClientError as ce:
-                    libby_client.clear_settings()
-                    raise OdmpyRuntimeError(
-                        "Could not log in with code.\n"
-                        "Make sure that you have entered the right code and within the time limit."
-                    ) from ce
-
-            synced_state = libby_client.sync()
-            cards = synced_state.get("cards", [])
-            # sort by checkout date so that recent most is at the bottom
-            libby_loans = sorted(
-                [
-                    book
-                    for book in synced_state.get("loans", [])
-                    if (
-                        (not args.exclude_audiobooks)
-                        and libby_client.is_downloadable_audiobook_loan(book)
-                    )
-                    or (
-                        args.include_ebooks
-                        and libby_client.is_downloadable_ebook_loan(book)
-                    )
-                    or (
-                        args.include_magazines
-                        and libby_client.is_downloadable_magazine_loan(book)
-                    )
-                ],
-                key=lambda ln: ln["checkoutDate"],  # type: ignore[no-any-return]
-            )
-
-            if args.command_name == OdmpyCommands.Libby and args.export_loans_path:
-                logger.info(
-                    "Non-interactive mode. Exporting loans json to %s...",
-                    colored(args.export_loans_path, "magenta"),
-                )
-                with open(args.export_loans_path, "w", encoding="utf-8") as f:
-                    json.dump(libby_loans, f)
-                    logger.info(
-                        'Saved loans as "%s"',
-                        colored(args.export_loans_path, "magenta", attrs=["bold"]),
-                    )
-                return
-
-            if args.command_name == OdmpyCommands.LibbyRenew:
-                libby_loans = [
-                    loan for loan in libby_loans if libby_client.is_renewable(loan)
-                ]
-                if not libby_loans:
-                    logger.info("No renewable loans found.")
-                    return
-
-            if not libby_loans:
-                logger.info("No downloadable loans found.")
-                return
-
-            if args.command_name == OdmpyCommands.Libby and (
-                args.selected_loans_indices
-                or args.download_latest_n
-                or args.selected_loans_ids
-            ):
-                # Non-interactive selection
-                selected_loans_indices = []
-                total_loans_count = len(libby_loans)
-                if args.selected_loans_indices:
-                    selected_loans_indices.extend(
-                        [
-                            j
-                            for j in args.selected_loans_indices
-                            if j <= total_loans_count
-                        ]
-                    )
-                    logger.info(
-                        "Non-interactive mode. Downloading selected %s %s...",
-                        ps(len(selected_loans_indices), "loan"),
-                        colored(
-                            ", ".join([str(i) for i in selected_loans_indices]),
-                            "blue",
-                            attrs=["bold"],
-                        ),
-                    )
-                if args.download_latest_n:
-                    logger.info(
-                        "Non-interactive mode. Downloading latest %s %s...",
-                        colored(str(args.download_latest_n), "blue"),
-                        ps(args.download_latest_n, "loan"),
-                    )
-                    selected_loans_indices.extend(
-                        list(range(1, len(libby_loans) + 1))[-args.download_latest_n :]
-                    )
-                if args.selected_loans_ids:
-                    selected_loans_ids = [str(i) for i in args.selected_loans_ids]
-                    logger.info(
-                        "Non-interactive mode. Downloading loans with %s %s...",
-                        ps(len(selected_loans_ids), "ID"),
-                        ", ".join([colored(i, "blue") for i in selected_loans_ids]),
-                    )
-                    for n, loan in enumerate(libby_loans, start=1):
-                        if loan["id"] in selected_loans_ids:
-                            selected_loans_indices.append(n)
-                selected_loans_indices = sorted(list(set(selected_loans_indices)))
-                selected_loans: List[Dict] = [
-                    libby_loans[j - 1] for j in selected_loans_indices
-                ]
-                if args.libby_direct:
-                    for selected_loan in selected_loans:
-                        logger.info(
-                            'Opening %s "%s"...',
-                            selected_loan.get("type", {}).get("id"),
-                            colored(selected_loan["title"], "blue"),
-                        )
-                        if libby_client.is_downloadable_audiobook_loan(selected_loan):
-                            openbook, toc = libby_client.process_audiobook(
-                                selected_loan
-                            )
-                            process_audiobook_loan(
-                                selected_loan,
-                                openbook,
-                                toc,
-                                libby_client.libby_session,
-                                args,
-                                logger,
-                            )
-                            extract_bundled_contents(
-                                libby_client,
-                                overdrive_client,
-                                selected_loan,
-                                cards,
-                                args,
-                            )
-                            continue
-                        elif libby_client.is_downloadable_ebook_loan(
-                            selected_loan
-                        ) or libby_client.is_downloadable_magazine_loan(selected_loan):
-                            extract_loan_file(libby_client, selected_loan, args)
-                            continue
-                    return
-
-                for selected_loan in selected_loans:
-                    logger.info(
-                        'Opening %s "%s"...',
-                        selected_loan.get("type", {}).get("id"),
-                        colored(selected_loan["title"], "blue"),
-                    )
-                    if libby_client.is_downloadable_audiobook_loan(selected_loan):
-                        process_odm(
-                            extract_loan_file(libby_client, selected_loan, args),
-                            selected_loan,
-                            args,
-                            logger,
-                            cleanup_odm_license=not args.keepodm,
-                        )
-                        extract_bundled_contents(
-                            libby_client,
-                            overdrive_client,
-                            selected_loan,
-                            cards,
-                            args,
-                        )
-
-                    elif libby_client.is_downloadable_ebook_loan(
-                        selected_loan
-                    ) or libby_client.is_downloadable_magazine_loan(selected_loan):
-                        extract_loan_file(libby_client, selected_loan, args)
-                        continue
-
-                return  # non-interactive libby downloads
-
-            # Interactive mode
-            holds = synced_state.get("holds", [])
-            logger.info(
-                "Found %s %s.",
-                colored(str(len(libby_loans)), "blue"),
-                ps(len(libby_loans), "loan"),
-            )
-            for index, loan in enumerate(libby_loans, start=1):
-                expiry_date = LibbyClient.parse_datetime(loan["expireDate"])
-                hold = next(
-                    iter(
-                        [
-                            h
-                            for h in holds
-                            if h["cardId"] == loan["cardId"] and h["id"] == loan["id"]
-                        ]
-                    ),
-                    None,
-                )
-                hold_date = (
-                    LibbyClient.parse_datetime(hold["placedDate"]) if hold else None
-                )
-
-                logger.info(
-                    "%s: %-55s  %s %-25s  \n    * %s  %s%s",
-                    colored(f"{index:2d}", attrs=["bold"]),
-                    colored(loan["title"], attrs=["bold"]),
-                    "📰"
-                    if args.include_magazines
-                    and libby_client.is_downloadable_magazine_loan(loan)
-                    else "📕"
-                    if args.include_ebooks
-                    and libby_client.is_downloadable_ebook_loan(loan)
-                    else "🎧"
-                    if args.include_ebooks or args.include_magazines
-                    else "",
-                    loan["firstCreatorName"]
-                    if loan.get("firstCreatorName")
-                    else loan.get("edition", ""),
-                    f"Expires: {colored(f'{expiry_date:%Y-%m-%d}','blue' if libby_client.is_renewable(loan) else None)}",
-                    next(
-                        iter(
-                            [
-                                c["library"]["name"]
-                                for c in cards
-                                if c["cardId"] == loan["cardId"]
-                            ]
-                        )
-                    ),
-                    ""
-                    if not libby_client.is_renewable(loan)
-                    else (
-                        f'\n    * {loan.get("availableCopies", 0)} '
-                        f'{ps(loan.get("availableCopies", 0), "copy", "copies")} available'
-                    )
-                    + (f" (hold placed: {hold_date:%Y-%m-%d})" if hold else ""),
-                )
-            loan_choices: List[str] = []
-
-            # Loans display and user choice prompt
-            libby_mode = "download"
-            if args.command_name == OdmpyCommands.LibbyReturn:
-                libby_mode = "return"
-            elif args.command_name == OdmpyCommands.LibbyRenew:
-                libby_mode = "renew"
-            while True:
-                user_loan_choice_input = input(
-                    f'\n{colored(libby_mode.title(), "magenta", attrs=["bold"])}. '
-                    f'Choose from {colored(f"1-{len(libby_loans)}", attrs=["bold"])} '
-                    "(separate choices with a space or leave blank to quit), \n"
-                    "then press enter: "
-                ).strip()
-                if not user_loan_choice_input:
-                    # abort choice if user enters blank
-                    break
-
-                loan_choices = list(set(user_loan_choice_input.split(" ")))
-                loan_choices_isvalid = True
-                for loan_index_selected in loan_choices:
-                    if (
-                        (not loan_index_selected.isdigit())
-                        or int(loan_index_selected) < 0
-                        or int(loan_index_selected) > len(libby_loans)
-                    ):
-                        logger.warning(f"Invalid choice: {loan_index_selected}")
-                        loan_choices_isvalid = False
-                        loan_choices = []
-                        break
-                if loan_choices_isvalid:
-                    break
-
-            if not loan_choices:
-                # abort if no choices made
-                return
-
-            loan_choices = sorted(loan_choices, key=int)
-
-            if args.command_name == OdmpyCommands.LibbyReturn:
-                # do returns
-                for c in loan_choices:
-                    selected_loan = libby_loans[int(c) - 1]
-                    logger.info(
-                        'Returning loan "%s"...',
-                        colored(selected_loan["title"], "blue"),
-                    )
-                    libby_client.return_loan(selected_loan)
-                    logger.info(
-                        'Returned "%s".',
-                        colored(selected_loan["title"], "blue"),
-                    )
-                return  # end libby return command
-
-            if args.command_name == OdmpyCommands.LibbyRenew:
-                # do renewals
-                for c in loan_choices:
-                    selected_loan = libby_loans[int(c) - 1]
-                    logger.info(
-                        'Renewing loan "%s"...',
-                        colored(selected_loan["title"], "blue"),
-                    )
-                    try:
-                        _ = libby_client.renew_loan(selected_loan)
-                        logger.info(
-                            'Renewed "%s".',
-                            colored(selected_loan["title"], "blue"),
-                        )
-                    except ClientBadRequestError as badreq_err:
-                        logger.warning(
-                            'Error encountered while renewing "%s": %s',
-                            selected_loan["title"],
-                            colored(badreq_err.msg, "red"),
-                        )
-                        if selected_loan.get("availableCopies", 0) == 0 and not [
-                            h
-                            for h in holds
-                            if h["cardId"] == selected_loan["cardId"]
-                            and h["id"] == selected_loan["id"]
-                        ]:
-                            # offer to make a hold
-                            make_hold = input(
-                                "Do you wish to place a hold instead? (y/n): "
-                            ).strip()
-                            if make_hold == "y":
-                                hold = libby_client.create_hold(
-                                    selected_loan["id"], selected_loan["cardId"]
-                                )
-                                logger.info(
-                                    "Hold successfully created for %s. You are #%s in line. %s %s in use. Available in ~%s %s.",
-                                    colored(hold["title"], attrs=["bold"]),
-                                    hold.get("holdListPosition", 0),
-                                    hold.get("ownedCopies"),
-                                    ps(hold.get("ownedCopies", 0), "copy", "copies"),
-                                    hold.get("estimatedWaitDays", 0),
-                                    ps(hold.get("estimatedWaitDays", 0), "day"),
-                                )
-
-                return  # end libby renew command
-
-            if args.command_name == OdmpyCommands.Libby:
-                # do downloads
-                if args.libby_direct:
-                    for c in loan_choices:
-                        selected_loan = libby_loans[int(c) - 1]
-                        logger.info(
-                            'Opening %s "%s"...',
-                            selected_loan.get("type", {}).get("id"),
-                            colored(selected_loan["title"], "blue"),
-                        )
-                        if libby_client.is_downloadable_audiobook_loan(selected_loan):
-                            openbook, toc = libby_client.process_audiobook(
-                                selected_loan
-                            )
-                            process_audiobook_loan(
-                                selected_loan,
-                                openbook,
-                                toc,
-                                libby_client.libby_session,
-                                args,
-                                logger,
-                            )
-                            extract_bundled_contents(
-                                libby_client,
-                                overdrive_client,
-                                selected_loan,
-                                cards,
-                                args,
-                            )
-                            continue
-                        elif libby_client.is_downloadable_ebook_loan(
-                            selected_loan
-                        ) or libby_client.is_downloadable_magazine_loan(selected_loan):
-                            extract_loan_file(libby_client, selected_loan, args)
-                            continue
-
-                    return
-
-                for c in loan_choices:
-                    selected_loan = libby_loans[int(c) - 1]
-                    logger.info(
-                        'Opening %s "%s"...',
-                        selected_loan.get("type", {}).get("id"),
-                        colored(selected_loan["title"], "blue"),
-                    )
-                    if libby_client.is_downloadable_audiobook_loan(selected_loan):
-                        process_odm(
-                            extract_loan_file(libby_client, selected_loan, args),
-                            selected_loan,
-                            args,
-                            logger,
-                            cleanup_odm_license=not args.keepodm,
-                        )
-                        extract_bundled_contents(
-                            libby_client,
-                            overdrive_client,
-                            selected_loan,
-                            cards,
-                            args,
-                        )
-                        continue
-                    elif libby_client.is_downloadable_ebook_loan(
-                        selected_loan
-                    ) or libby_client.is_downloadable_magazine_loan(selected_loan):
-                        extract_loan_file(libby_client, selected_loan, args)
-                        continue
-                return
-
-            return  # end libby commands
-
-        # Legacy ODM-based commands from here on
-
+    handler = _DISPATCH.get(args.command_name)
+    if not handler:
         # because py<=3.6 does not support `add_subparsers(required=True)`
-        try:
-            # test for odm file
-            args.odm_file
-        except AttributeError:
-            parser.print_help()
-            return
-
-        # Return Book
-        if args.command_name == OdmpyCommands.Return:
-            process_odm_return(args, logger)
-            return
+        _build_parser(_SUBPARSER_BUILDERS).print_help()
+        return
 
-        if args.command_name in (OdmpyCommands.Download, OdmpyCommands.Information):
-            if args.command_name == OdmpyCommands.Download:
-                logger.info(
-                    'Opening odm "%s"...',
-                    colored(args.odm_file, "blue"),
-                )
-            process_odm(Path(args.odm_file), {}, args, logger)
-            return
-
-    except OdmpyRuntimeError as run_err:
-        logger.error(
-            "%s %s",
-            colored("Error:", attrs=["bold"]),
-            colored(str(run_err), "red"),
-        )
-        raise
-
-    except Exception:  # noqa: E722, pylint: disable=broad-except
-        logger.exception(colored("An unexpected error has occurred", "red"))
+    try:
+        handler(args, logger)
+    except Exception as err:  # noqa: E722, pylint: disable=broad-except
+        if isinstance(err, OdmpyRuntimeError):
+            logger.error(
+                "%s %s",
+                colored("Error:", attrs=["bold"]),
+                colored(str(err), "red"),
+            )
+        else:
+            logger.exception(colored("An unexpected error has occurred", "red"))
         raise
-
-    # we shouldn't get this error
-    logger.error("Unknown command: %s", colored(args.command_name, "red"))
+    finally:
+        if version_check_thread:
+            # usually done by now, otherwise wait for it as long as
+            # the request timeout so that the notice is not lost
+            version_check_thread.join(timeout=args.timeout)
+        for new_version in new_versions:
+            logger.warning(
+                f"⚠️  A new version {new_version} is available at {REPOSITORY_URL}."
+            )
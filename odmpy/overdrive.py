@@ -17,12 +17,16 @@
 #
 
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from typing import Optional, Dict, List
 from urllib.parse import urljoin
 
 import requests
 from requests.adapters import HTTPAdapter, Retry
 
+from .utils import json_loads
+
 #
 # Basic skeletal client for the OverDrive Thunder API
 #
@@ -36,6 +40,11 @@ THUNDER_API_URL = "https://thunder.api.overdrive.com/v2/"
 CLIENT_ID = "dewey"
 
 
+@lru_cache(maxsize=64)
+def _api_url(endpoint: str) -> str:
+    return urljoin(THUNDER_API_URL, endpoint)
+
+
 class OverDriveClient(object):
     """
     A really simplified OverDrive Thunder API client
@@ -49,18 +58,34 @@ class OverDriveClient(object):
             - user_agent: User Agent string for requests
             - timeout: The timeout interval for a network request. Default 15 (seconds).
             - retries: The number of times to retry a network request on failure. Default 0.
+            - session: An existing requests.Session to reuse, e.g. to keep its connections
         """
         self.logger = logging.getLogger(__name__)
         self.user_agent = kwargs.pop("user_agent", USER_AGENT)
         self.timeout = int(kwargs.pop("timeout", 15))
         self.retries = int(kwargs.pop("retry", 0))
-
-        session = requests.Session()
-        adapter = HTTPAdapter(max_retries=Retry(total=self.retries, backoff_factor=0.1))
-        # noinspection HttpUrlsUsage
-        for prefix in ("http://", "https://"):
-            session.mount(prefix, adapter)
-        self.session = kwargs.pop("session", None) or session
+        self._default_headers = {
+            "User-Agent": self.user_agent,
+            "Referer": SITE_URL + "/",
+            "Origin": SITE_URL,
+            "Cache-Control": "no-cache",
+            "Pragma": "no-cache",
+        }
+        self._default_params = {"x-client-id": CLIENT_ID}
+
+        session: Optional[requests.Session] = kwargs.pop("session", None)
+        if not session:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                # sized for concurrent lookups, e.g. bundled content
+                pool_connections=16,
+                pool_maxsize=32,
+                max_retries=Retry(total=self.retries, backoff_factor=0.1),
+            )
+            # noinspection HttpUrlsUsage
+            for prefix in ("http://", "https://"):
+                session.mount(prefix, adapter)
+        self.session = session
 
     def default_headers(self) -> Dict:
         """
@@ -68,14 +93,7 @@ class OverDriveClient(object):
 
         :return:
         """
-        headers = {
-            "User-Agent": self.user_agent,
-            "Referer": SITE_URL + "/",
-            "Origin": SITE_URL,
-            "Cache-Control": "no-cache",
-            "Pragma": "no-cache",
-        }
-        return headers
+        return dict(self._default_headers)
 
     def default_params(self) -> Dict:
         """
@@ -83,8 +101,7 @@ class OverDriveClient(object):
 
         :return:
         """
-        params = {"x-client-id": CLIENT_ID}
-        return params
+        return dict(self._default_params)
 
     def make_request(
         self,
@@ -104,8 +121,9 @@ class OverDriveClient(object):
         :param headers: Custom headers
         :return: Union[List, Dict, str]
         """
-        endpoint_url = urljoin(THUNDER_API_URL, endpoint)
-        headers = headers or self.default_headers()
+        endpoint_url = _api_url(endpoint)
+        # not modified, so the defaults don't need to be copied
+        headers = headers or self._default_headers
         if not method:
             # try to set an HTTP method
             if data is not None:
@@ -113,19 +131,21 @@ class OverDriveClient(object):
             else:
                 method = "GET"
 
-        req = requests.Request(
+        res = self.session.request(
             method,
             endpoint_url,
             headers=headers,
             params=params,
             data=data,
+            timeout=self.timeout,
         )
-        res = self.session.send(self.session.prepare_request(req), timeout=self.timeout)
-        self.logger.debug("body: %s", res.text)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            # decoding the text is not free, only do it when it gets logged
+            self.logger.debug("body: %s", res.text)
         res.raise_for_status()
 
         if res.headers.get("content-type", "").startswith("application/json"):
-            return res.json()
+            return json_loads(res.content)
         return res.text
 
     def media(self, title_id: str, **kwargs) -> Dict:
@@ -179,6 +199,31 @@ class OverDriveClient(object):
             f"libraries/{library_key}/media/{title_id}", params=params
         )
 
+    def library_media_concurrent(
+        self, library_key: str, title_ids: List[str], max_workers: int = 8, **kwargs
+    ) -> List[Dict]:
+        """
+        Get titles by making concurrent `library_media()` requests.
+
+        :param library_key: A unique key that identifies the library
+        :param title_ids:
+        :param max_workers: Maximum number of concurrent requests
+        :return: Titles in the same order as `title_ids`
+        """
+        if not title_ids:
+            return []
+        with ThreadPoolExecutor(
+            max_workers=min(max_workers, len(title_ids))
+        ) as executor:
+            return list(
+                executor.map(
+                    lambda title_id: self.library_media(
+                        library_key, title_id, **kwargs
+                    ),
+                    title_ids,
+                )
+            )
+
     def library_media_availability(
         self, library_key: str, title_id: str, **kwargs
     ) -> dict:
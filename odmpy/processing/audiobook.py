@@ -18,34 +18,37 @@
 
 import argparse
 import datetime
-import json
 import logging
-import shutil
+from pathlib import Path
 from typing import Optional, Any, Dict, List
 from typing import OrderedDict as OrderedDictType
 
 import eyed3  # type: ignore[import]
 import requests
 from eyed3.id3 import ID3_DEFAULT_VERSION, ID3_V2_3, ID3_V2_4  # type: ignore[import]
-from requests.exceptions import HTTPError, ConnectionError
 from termcolor import colored
-from tqdm import tqdm
 
 from .shared import (
     generate_names,
     write_tags,
     generate_cover,
-    remux_mp3,
     merge_into_mp3,
     convert_to_m4b,
     create_opf,
+    drop_file_cache,
+    delete_file,
+    delete_files,
+    set_chapter,
     get_best_cover_url,
+    get_media_info,
+    group_creators_by_role,
     extract_isbn,
+    download_part_files,
+    PartDownload,
 )
-from ..errors import OdmpyRuntimeError
 from ..libby import USER_AGENT, merge_toc, PartMeta, LibbyFormats
 from ..overdrive import OverDriveClient
-from ..utils import slugify, plural_or_singular_noun as ps
+from ..utils import slugify, plural_or_singular_noun as ps, json_dumps_bytes
 
 
 #
@@ -60,6 +63,7 @@ def process_audiobook_loan(
     session: requests.Session,
     args: argparse.Namespace,
     logger: logging.Logger,
+    cache_folder: Optional[Path] = None,
 ) -> None:
     """
     Download the audiobook loan directly via Libby without the use of
@@ -71,6 +75,7 @@ def process_audiobook_loan(
     :param session: From `LibbyClient.libby_session` because it contains a needed auth cookie
     :param args:
     :param logger:
+    :param cache_folder: From `LibbyClient.cache_folder`, for caching the title's media info
     :return:
     """
 
@@ -85,22 +90,14 @@ def process_audiobook_loan(
     overdrive_media_id = loan["id"]
     sub_title = loan.get("subtitle", None)
     cover_url = get_best_cover_url(loan)
-    authors = [
-        c["name"] for c in openbook.get("creator", []) if c.get("role", "") == "author"
-    ]
-    if not authors:
-        authors = [
-            c["name"]
-            for c in openbook.get("creator", [])
-            if c.get("role", "") == "editor"
-        ]
-    if not authors:
-        authors = [c["name"] for c in openbook.get("creator", [])]
-    narrators = [
-        c["name"]
-        for c in openbook.get("creator", [])
-        if c.get("role", "") == "narrator"
-    ]
+    creators = openbook.get("creator", [])
+    creators_by_role = group_creators_by_role(creators)
+    authors = (
+        creators_by_role.get("author")
+        or creators_by_role.get("editor")
+        or [c["name"] for c in creators]
+    )
+    narrators = creators_by_role.get("narrator", [])
     languages: Optional[List[str]] = (
         [str(openbook.get("language"))] if openbook.get("language") else []
     )
@@ -158,29 +155,24 @@ def process_audiobook_loan(
         logger=logger,
     )
     book_m4b_filename = book_filename.with_suffix(".m4b")
+    merged_book_filename = (
+        book_filename if args.merge_format == "mp3" else book_m4b_filename
+    )
 
     # check early if a merged file is already saved
-    if (
-        args.merge_output
-        and (
-            book_filename if args.merge_format == "mp3" else book_m4b_filename
-        ).exists()
-    ):
+    if args.merge_output and merged_book_filename.exists():
         logger.warning(
             'Already saved "%s"',
-            colored(
-                str(book_filename if args.merge_format == "mp3" else book_m4b_filename),
-                "magenta",
-            ),
+            colored(str(merged_book_filename), "magenta"),
         )
         return
 
     if args.is_debug_mode:
-        with book_folder.joinpath("loan.json").open("w", encoding="utf-8") as f:
-            json.dump(loan, f, indent=2)
+        with book_folder.joinpath("loan.json").open("wb") as f:
+            f.write(json_dumps_bytes(loan, indent=True))
 
-        with book_folder.joinpath("openbook.json").open("w", encoding="utf-8") as f:
-            json.dump(openbook, f, indent=2)
+        with book_folder.joinpath("openbook.json").open("wb") as f:
+            f.write(json_dumps_bytes(openbook, indent=True))
 
     cover_filename, cover_bytes = generate_cover(
         book_folder=book_folder,
@@ -193,130 +185,97 @@ def process_audiobook_loan(
     keep_cover = args.always_keep_cover
     file_tracks = []
     audio_bitrate = 0
-    for p in download_parts:
-        part_number = p["spine-position"] + 1
-        part_filename = book_folder.joinpath(
-            f"{slugify(f'{title} - Part {part_number:02d}', allow_unicode=True)}.mp3"
+    # same names as slugify(f"{title} - Part {part_number:02d}"),
+    # without slugifying the title again for every part
+    part_filename_prefix = slugify(f"{title} - Part", allow_unicode=True)
+    part_filenames = [
+        book_folder.joinpath(f"{part_filename_prefix}-{part_number:02d}.mp3")
+        for part_number in (p["spine-position"] + 1 for p in download_parts)
+    ]
+    # download the missing parts first, concurrently if requested
+    new_parts = [
+        PartDownload(
+            number=p["spine-position"] + 1,
+            url=p["url"],
+            file_size=p["file-length"],
+            filename=part_filename,
         )
-        part_tmp_filename = part_filename.with_suffix(".part")
-        part_file_size = p["file-length"]
-        part_download_url = p["url"]
-
-        if part_filename.exists():
-            logger.warning("Already saved %s", colored(str(part_filename), "magenta"))
-        else:
-            try:
-                already_downloaded_len = 0
-                if part_tmp_filename.exists():
-                    already_downloaded_len = part_tmp_filename.stat().st_size
-
-                part_download_res = session.get(
-                    part_download_url,
-                    headers={
-                        "User-Agent": USER_AGENT,
-                        "Range": f"bytes={already_downloaded_len}-"
-                        if already_downloaded_len
-                        else None,
-                    },
-                    timeout=args.timeout,
-                    stream=True,
-                )
-                part_download_res.raise_for_status()
-
-                with tqdm.wrapattr(
-                    part_download_res.raw,
-                    "read",
-                    total=part_file_size,
-                    initial=already_downloaded_len,
-                    desc=f"Part {part_number:2d}",
-                    disable=args.hide_progress,
-                ) as res_raw:
-                    with part_tmp_filename.open(
-                        "ab" if already_downloaded_len else "wb"
-                    ) as outfile:
-                        shutil.copyfileobj(res_raw, outfile)
-
-                # try to remux file to remove mp3 lame tag errors
-                remux_mp3(
-                    part_tmp_filename=part_tmp_filename,
-                    part_filename=part_filename,
-                    ffmpeg_loglevel=ffmpeg_loglevel,
-                    logger=logger,
-                )
-
-            except HTTPError as he:
-                logger.error(f"HTTPError: {str(he)}")
-                logger.debug(he.response.content)
-                raise OdmpyRuntimeError("HTTP Error while downloading part file.")
-
-            except ConnectionError as ce:
-                logger.error(f"ConnectionError: {str(ce)}")
-                raise OdmpyRuntimeError("Connection Error while downloading part file.")
-
-            # Save id3 info only on new download, ref #42
-            # This also makes handling of part files consistent with merged files
-            try:
-                # Fill id3 info for mp3 part
-                audiofile = eyed3.load(part_filename)
-                variable_bitrate, audio_bitrate = audiofile.info.bit_rate
-                if variable_bitrate:
-                    # don't use vbr
-                    audio_bitrate = 0
-                write_tags(
-                    audiofile=audiofile,
-                    title=title,
-                    sub_title=sub_title,
-                    authors=authors,
-                    narrators=narrators,
-                    publisher=publisher,
-                    description=description,
-                    cover_bytes=cover_bytes,
-                    genres=subjects,
-                    languages=languages,
-                    published_date=publish_date,
-                    series=series,
-                    part_number=part_number,
-                    total_parts=len(download_parts),
-                    overdrive_id=overdrive_media_id,
-                    isbn=extract_isbn(
-                        loan.get("formats", []), [LibbyFormats.AudioBookMP3]
-                    ),
-                    always_overwrite=args.overwrite_tags,
-                    delimiter=args.tag_delimiter,
+        for p, part_filename in zip(download_parts, part_filenames)
+        if not part_filename.exists()
+    ]
+    parts_by_number = {p["spine-position"] + 1: p for p in download_parts}
+    # parts are tagged in the order they finish downloading, so keep the
+    # bitrates by part number to pick the last part's afterwards
+    part_bitrates: Dict[int, int] = {}
+
+    def _tag_part(part: PartDownload) -> None:
+        # Save id3 info only on new download, ref #42
+        # This also makes handling of part files consistent with merged files
+        nonlocal keep_cover
+        p = parts_by_number[part.number]
+        part_number = part.number
+        part_filename = part.filename
+        try:
+            # Fill id3 info for mp3 part
+            audiofile = eyed3.load(part_filename)
+            variable_bitrate, part_bitrate = audiofile.info.bit_rate
+            # don't use vbr
+            part_bitrates[part_number] = 0 if variable_bitrate else part_bitrate
+            write_tags(
+                audiofile=audiofile,
+                title=title,
+                sub_title=sub_title,
+                authors=authors,
+                narrators=narrators,
+                publisher=publisher,
+                description=description,
+                cover_bytes=cover_bytes,
+                genres=subjects,
+                languages=languages,
+                published_date=publish_date,
+                series=series,
+                part_number=part_number,
+                total_parts=len(download_parts),
+                overdrive_id=overdrive_media_id,
+                isbn=extract_isbn(loan.get("formats", []), [LibbyFormats.AudioBookMP3]),
+                always_overwrite=args.overwrite_tags,
+                delimiter=args.tag_delimiter,
+            )
+            if (
+                args.add_chapters
+                and not args.merge_output
+                and (args.overwrite_tags or not audiofile.tag.table_of_contents)
+            ):
+                if args.overwrite_tags and audiofile.tag.table_of_contents:
+                    # Clear existing toc to prevent "There may only be one top-level table of contents.
+                    # Toc 'b'toc'' is current top-level." error
+                    for f in list(audiofile.tag.table_of_contents):
+                        audiofile.tag.table_of_contents.remove(f.element_id)  # type: ignore[attr-defined]
+
+                toc = audiofile.tag.table_of_contents.set(
+                    "toc".encode("ascii"),
+                    toplevel=True,
+                    ordered=True,
+                    child_ids=[],
+                    description="Table of Contents",
                 )
-                audiofile.tag.save(version=id3v2_version)
-
-                if (
-                    args.add_chapters
-                    and not args.merge_output
-                    and (args.overwrite_tags or not audiofile.tag.table_of_contents)
-                ):
-                    if args.overwrite_tags and audiofile.tag.table_of_contents:
-                        # Clear existing toc to prevent "There may only be one top-level table of contents.
-                        # Toc 'b'toc'' is current top-level." error
-                        for f in list(audiofile.tag.table_of_contents):
-                            audiofile.tag.table_of_contents.remove(f.element_id)  # type: ignore[attr-defined]
-
-                    toc = audiofile.tag.table_of_contents.set(
-                        "toc".encode("ascii"),
-                        toplevel=True,
-                        ordered=True,
-                        child_ids=[],
-                        description="Table of Contents",
+                chapters_by_id = {c.element_id: c for c in audiofile.tag.chapters}
+                chapter_marks = p["chapters"]
+                for i, m in enumerate(chapter_marks):
+                    title_frameset = eyed3.id3.frames.FrameSet()
+                    title_frameset.setTextFrame(eyed3.id3.frames.TITLE_FID, m.title)
+                    chap = set_chapter(
+                        audiofile.tag,
+                        chapters_by_id,
+                        f"ch{i:02d}".encode("ascii"),
+                        times=(
+                            round(m.start_second * 1000),
+                            round(m.end_second * 1000),
+                        ),
+                        sub_frames=title_frameset,
                     )
-                    chapter_marks = p["chapters"]
-                    for i, m in enumerate(chapter_marks):
-                        title_frameset = eyed3.id3.frames.FrameSet()
-                        title_frameset.setTextFrame(eyed3.id3.frames.TITLE_FID, m.title)
-                        chap = audiofile.tag.chapters.set(
-                            f"ch{i:02d}".encode("ascii"),
-                            times=(
-                                round(m.start_second * 1000),
-                                round(m.end_second * 1000),
-                            ),
-                            sub_frames=title_frameset,
-                        )
-                        toc.child_ids.append(chap.element_id)
+                    toc.child_ids.append(chap.element_id)
+                    if logger.isEnabledFor(logging.DEBUG):
                         start_time = datetime.timedelta(seconds=m.start_second)
                         end_time = datetime.timedelta(seconds=m.end_second)
                         logger.debug(
@@ -327,26 +286,48 @@ def process_audiobook_loan(
                             colored(m.title, "cyan"),
                             colored(str(part_filename), "blue"),
                         )
-                    audiofile.tag.save(version=id3v2_version)
 
-            except Exception as e:  # pylint: disable=broad-except
-                logger.warning(
-                    "Error saving ID3: %s", colored(str(e), "red", attrs=["bold"])
-                )
-                keep_cover = True
+            # save the tags and chapters in a single write
+            audiofile.tag.save(version=id3v2_version)
+
+        except Exception as e:  # pylint: disable=broad-except
+            logger.warning(
+                "Error saving ID3: %s", colored(str(e), "red", attrs=["bold"])
+            )
+            keep_cover = True
+
+        if not args.merge_output:
+            # part is final, it won't be read again in this run
+            drop_file_cache(part_filename)
+        logger.info('Saved "%s"', colored(str(part_filename), "magenta"))
 
-            logger.info('Saved "%s"', colored(str(part_filename), "magenta"))
+    download_part_files(
+        session=session,
+        parts=new_parts,
+        headers={"User-Agent": USER_AGENT},
+        timeout=args.timeout,
+        parallelism=args.download_parallelism,
+        hide_progress=args.hide_progress,
+        ffmpeg_loglevel=ffmpeg_loglevel,
+        logger=logger,
+        # tag each part while the rest are still downloading
+        on_part_saved=_tag_part,
+        force_remux=args.force_remux,
+    )
+    new_part_filenames = {part.filename for part in new_parts}
+    if part_bitrates:
+        audio_bitrate = part_bitrates[max(part_bitrates)]
 
+    for part_filename in part_filenames:
+        if part_filename not in new_part_filenames:
+            logger.warning("Already saved %s", colored(str(part_filename), "magenta"))
         file_tracks.append({"file": part_filename})
 
     debug_meta["file_tracks"] = [{"file": str(ft["file"])} for ft in file_tracks]
     if args.merge_output:
         logger.info(
             'Generating "%s"...',
-            colored(
-                str(book_filename if args.merge_format == "mp3" else book_m4b_filename),
-                "magenta",
-            ),
+            colored(str(merged_book_filename), "magenta"),
         )
 
         merge_into_mp3(
@@ -396,6 +377,7 @@ def process_audiobook_loan(
                 child_ids=[],
                 description="Table of Contents",
             )
+            chapters_by_id = {c.element_id: c for c in audiofile.tag.chapters}
             merged_markers = merge_toc(parsed_toc)
             debug_meta["merged_markers"] = [
                 {"title": m.title, "start": m.start_second, "end": m.end_second}
@@ -405,36 +387,32 @@ def process_audiobook_loan(
             for i, m in enumerate(merged_markers):
                 title_frameset = eyed3.id3.frames.FrameSet()
                 title_frameset.setTextFrame(eyed3.id3.frames.TITLE_FID, m.title)
-                chap = audiofile.tag.chapters.set(
+                chap = set_chapter(
+                    audiofile.tag,
+                    chapters_by_id,
                     f"ch{i}".encode("ascii"),
                     times=(round(m.start_second * 1000), round(m.end_second * 1000)),
                     sub_frames=title_frameset,
                 )
                 toc.child_ids.append(chap.element_id)
-                start_time = datetime.timedelta(seconds=m.start_second)
-                end_time = datetime.timedelta(seconds=m.end_second)
-                logger.debug(
-                    'Added chap tag => %s: %s-%s "%s" to "%s"',
-                    colored(f"ch{i}", "cyan"),
-                    start_time,
-                    end_time,
-                    colored(m.title, "cyan"),
-                    colored(str(book_filename), "blue"),
-                )
+                if logger.isEnabledFor(logging.DEBUG):
+                    start_time = datetime.timedelta(seconds=m.start_second)
+                    end_time = datetime.timedelta(seconds=m.end_second)
+                    logger.debug(
+                        'Added chap tag => %s: %s-%s "%s" to "%s"',
+                        colored(f"ch{i}", "cyan"),
+                        start_time,
+                        end_time,
+                        colored(m.title, "cyan"),
+                        colored(str(book_filename), "blue"),
+                    )
 
         audiofile.tag.save(version=id3v2_version)
 
         if args.merge_format == "mp3":
             logger.info(
                 'Merged files into "%s"',
-                colored(
-                    str(
-                        book_filename
-                        if args.merge_format == "mp3"
-                        else book_m4b_filename
-                    ),
-                    "magenta",
-                ),
+                colored(str(book_filename), "magenta"),
             )
 
         if args.merge_format == "m4b":
@@ -449,18 +427,13 @@ def process_audiobook_loan(
                 logger=logger,
             )
 
+        drop_file_cache(merged_book_filename)
+
         if not args.keep_mp3:
-            for file_track in file_tracks:
-                try:
-                    file_track["file"].unlink()
-                except Exception as e:  # pylint: disable=broad-except
-                    logger.warning(f'Error deleting "{file_track["file"]}": {str(e)}')
+            delete_files([file_track["file"] for file_track in file_tracks], logger)
 
-    if not keep_cover and cover_filename.exists():
-        try:
-            cover_filename.unlink()
-        except Exception as e:  # pylint: disable=broad-except
-            logger.warning(f'Error deleting "{cover_filename}": {str(e)}')
+    if not keep_cover:
+        delete_file(cover_filename, logger)
 
     if args.generate_opf:
         if args.merge_output:
@@ -471,21 +444,18 @@ def process_audiobook_loan(
             )
         if not opf_file_path.exists():
             od_client = OverDriveClient(
-                user_agent=USER_AGENT, timeout=args.timeout, retry=args.retries
+                user_agent=USER_AGENT,
+                timeout=args.timeout,
+                retry=args.retries,
+                session=session,
             )
-            media_info = od_client.media(loan["id"])
+            media_info = get_media_info(od_client, loan["id"], cache_folder)
             create_opf(
                 media_info,
                 cover_filename if keep_cover else None,
                 file_tracks
                 if not args.merge_output
-                else [
-                    {
-                        "file": book_filename
-                        if args.merge_format == "mp3"
-                        else book_m4b_filename
-                    }
-                ],
+                else [{"file": merged_book_filename}],
                 opf_file_path,
                 logger,
             )
@@ -493,15 +463,15 @@ def process_audiobook_loan(
             logger.info("Already saved %s", colored(str(opf_file_path), "magenta"))
 
     if args.write_json:
-        with book_folder.joinpath("debug.json").open("w", encoding="utf-8") as outfile:
-            json.dump(debug_meta, outfile, indent=2)
+        with book_folder.joinpath("debug.json").open("wb") as outfile:
+            outfile.write(json_dumps_bytes(debug_meta, indent=True))
 
     if not args.is_debug_mode:
         # clean up
-        for file_name in (
-            "openbook.json",
-            "loan.json",
-        ):
-            target = book_folder.joinpath(file_name)
-            if target.exists():
-                target.unlink()
+        delete_files(
+            [
+                book_folder.joinpath(file_name)
+                for file_name in ("openbook.json", "loan.json")
+            ],
+            logger,
+        )
@@ -19,7 +19,6 @@
 import argparse
 import base64
 import datetime
-import json
 import logging
 import os
 import re
@@ -42,11 +41,12 @@ from .shared import (
     build_opf_package,
     extract_isbn,
     extract_authors_from_openbook,
+    get_media_info,
 )
 from ..errors import OdmpyRuntimeError
 from ..libby import USER_AGENT, LibbyClient, LibbyFormats, LibbyMediaTypes
 from ..overdrive import OverDriveClient
-from ..utils import slugify, is_windows, guess_mimetype
+from ..utils import slugify, is_windows, guess_mimetype, json_dumps_bytes
 
 #
 # Main processing logic for libby direct ebook and magazine loans
@@ -408,22 +408,25 @@ def process_ebook_loan(
             d.mkdir(parents=True, exist_ok=True)
 
     od_client = OverDriveClient(
-        user_agent=USER_AGENT, timeout=args.timeout, retry=args.retries
+        user_agent=USER_AGENT,
+        timeout=args.timeout,
+        retry=args.retries,
+        session=libby_client.libby_session,
     )
-    media_info = od_client.media(loan["id"])
+    media_info = get_media_info(od_client, loan["id"], libby_client.cache_folder)
 
     if args.is_debug_mode:
-        with book_folder.joinpath("media.json").open("w", encoding="utf-8") as f:
-            json.dump(media_info, f, indent=2)
+        with book_folder.joinpath("media.json").open("wb") as f:
+            f.write(json_dumps_bytes(media_info, indent=True))
 
-        with book_folder.joinpath("loan.json").open("w", encoding="utf-8") as f:
-            json.dump(loan, f, indent=2)
+        with book_folder.joinpath("loan.json").open("wb") as f:
+            f.write(json_dumps_bytes(loan, indent=True))
 
-        with book_folder.joinpath("rosters.json").open("w", encoding="utf-8") as f:
-            json.dump(rosters, f, indent=2)
+        with book_folder.joinpath("rosters.json").open("wb") as f:
+            f.write(json_dumps_bytes(rosters, indent=True))
 
-        with book_folder.joinpath("openbook.json").open("w", encoding="utf-8") as f:
-            json.dump(openbook, f, indent=2)
+        with book_folder.joinpath("openbook.json").open("wb") as f:
+            f.write(json_dumps_bytes(openbook, indent=True))
 
     title_contents: Dict = next(
         iter([r for r in rosters if r["group"] == "title-content"]), {}
@@ -957,8 +960,9 @@ def process_ebook_loan(
             "loan.json",
             "rosters.json",
         ):
-            target = book_folder.joinpath(file_name)
-            if target.exists():
-                target.unlink()
+            try:
+                book_folder.joinpath(file_name).unlink()
+            except FileNotFoundError:
+                pass
         for folder in (book_content_folder, book_meta_folder):
             shutil.rmtree(folder, ignore_errors=True)
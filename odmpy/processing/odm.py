@@ -24,30 +24,33 @@ import json
 import logging
 import math
 import re
-import shutil
 import uuid
-import xml.etree.ElementTree as ET
-from collections import OrderedDict
-from functools import reduce
+from itertools import accumulate, chain
 from html import unescape as unescape_html
 from pathlib import Path
 from typing import Any, Union, Dict, List, Optional
+from xml.sax.saxutils import escape as xml_escape
 
 import eyed3  # type: ignore[import]
 from eyed3.id3 import ID3_DEFAULT_VERSION, ID3_V2_3, ID3_V2_4  # type: ignore[import]
+from lxml import etree as ET  # type: ignore[import]
 from requests.exceptions import HTTPError, ConnectionError
 from termcolor import colored
-from tqdm import tqdm
 
 from .shared import (
     generate_names,
     write_tags,
     generate_cover,
-    remux_mp3,
     merge_into_mp3,
     convert_to_m4b,
     create_opf,
+    drop_file_cache,
+    delete_file,
+    delete_files,
+    set_chapter,
     init_session,
+    download_part_files,
+    PartDownload,
 )
 from ..cli_utils import OdmpyCommands
 from ..constants import OMC, OS, UA, UNSUPPORTED_PARSER_ENTITIES, UA_LONG
@@ -60,12 +63,27 @@ from ..utils import (
     parse_duration_to_seconds,
     parse_duration_to_milliseconds,
     get_element_text,
+    json_dumps_bytes,
     plural_or_singular_noun as ps,
 )
 
 RESERVE_ID_RE = re.compile(
     r"(?P<reserve_id>[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})"
 )
+AMP_FIXUP_RE = re.compile(r"\s&\s")
+ENTITY_RE = re.compile(r"&(?P<name>[A-Za-z][A-Za-z0-9]*);")
+# don't load DTDs or expand entities declared in them, e.g. external entities
+# in a crafted odm that would pull local files into the parsed metadata
+XML_PARSER = ET.XMLParser(
+    resolve_entities=False,
+    no_network=True,
+    load_dtd=False,
+    # like ElementTree, so that only elements are iterated over
+    remove_comments=True,
+    remove_pis=True,
+)
+# constant tail of the license request hash input
+LICENSE_HASH_SUFFIX = f"|{OMC}|{OS}|ELOSNOC*AIDEM*EVIRDREVO".encode("utf-16-le")
 
 #
 # Main processing logic for odm-based downloads
@@ -73,16 +91,15 @@ RESERVE_ID_RE = re.compile(
 
 
 def _patch_for_parse_error(text: str) -> str:
-    # [TODO]: Find a more generic solution instead of patching entities, maybe lxml?
+    # [TODO]: Find a more generic solution instead of patching entities
     # Ref: https://github.com/ping/odmpy/issues/19
-    return "<!DOCTYPE xml [{patch}]>{text}".format(
-        patch="".join(
-            [
-                f'<!ENTITY {entity} "{replacement}">'
-                for entity, replacement in UNSUPPORTED_PARSER_ENTITIES.items()
-            ]
-        ),
-        text=text,
+    # Replace the entities directly instead of declaring them in a DTD
+    # because the parser does not expand DTD entities
+    return ENTITY_RE.sub(
+        lambda m: xml_escape(UNSUPPORTED_PARSER_ENTITIES[m.group("name")])
+        if m.group("name") in UNSUPPORTED_PARSER_ENTITIES
+        else m.group(0),
+        text,
     )
 
 
@@ -116,22 +133,29 @@ def process_odm(
         if args.id3v2_version == 4:
             id3v2_version = ID3_V2_4
 
-    xml_doc = ET.parse(odm_file)
+    xml_doc = ET.parse(str(odm_file), XML_PARSER)
     root = xml_doc.getroot()
     overdrive_media_id = root.attrib.get("id", "")
+    # the Metadata CDATA is usually a direct text node of the root,
+    # so check those first before walking every text node in the odm
+    metadata_text = next(
+        (
+            t
+            for t in chain([root.text], (c.tail for c in root))
+            if t and t.startswith("<Metadata>")
+        ),
+        None,
+    ) or next((t for t in root.itertext() if t.startswith("<Metadata>")), None)
     metadata = None
-    for t in root.itertext():
-        if not t.startswith("<Metadata>"):
-            continue
+    if metadata_text:
         # remove invalid '&' char
-        text = re.sub(r"\s&\s", " &amp; ", t)
+        text = AMP_FIXUP_RE.sub(" &amp; ", metadata_text)
         try:
-            metadata = ET.fromstring(text)
+            metadata = ET.fromstring(text, XML_PARSER)
         except ET.ParseError:
-            metadata = ET.fromstring(_patch_for_parse_error(text))
-        break
+            metadata = ET.fromstring(_patch_for_parse_error(text), XML_PARSER)
 
-    if not metadata:
+    if metadata is None:
         raise ValueError("Unable to find Metadata in ODM")
 
     title = get_element_text(metadata.find("Title"))
@@ -140,34 +164,33 @@ def process_odm(
     description = get_element_text(metadata.find("Description"))
     series = get_element_text(metadata.find("Series"))
     cover_url = get_element_text(metadata.find("CoverUrl"))
+    # look up the repeatedly used elements once
+    creator_eles = metadata.findall("Creators/*")
+    language_eles = metadata.findall("Languages/*")
     authors = [
         unescape_html(get_element_text(c))
-        for c in metadata.find("Creators") or []
+        for c in creator_eles
         if "Author" in c.attrib.get("role", "")
     ]
     if not authors:
         authors = [
             unescape_html(get_element_text(c))
-            for c in metadata.find("Creators") or []
+            for c in creator_eles
             if "Editor" in c.attrib.get("role", "")
         ]
     if not authors:
-        authors = [
-            unescape_html(get_element_text(c))
-            for c in metadata.find("Creators") or []
-            if c.text
-        ]
+        authors = [unescape_html(get_element_text(c)) for c in creator_eles if c.text]
     narrators = [
         unescape_html(get_element_text(c))
-        for c in metadata.find("Creators") or []
+        for c in creator_eles
         if "Narrator" in c.attrib.get("role", "")
     ]
     languages = [
         lang.attrib.get("code", "")
-        for lang in metadata.find("Languages") or []
+        for lang in language_eles
         if lang.attrib.get("code", "")
     ]
-    subjects = [subj.text for subj in metadata.find("Subjects") or [] if subj.text]
+    subjects = [subj.text for subj in metadata.findall("Subjects/*") if subj.text]
 
     debug_meta: Dict[str, Any] = {
         "meta": {
@@ -181,98 +204,91 @@ def process_odm(
 
     # View Book Info
     if args.command_name == OdmpyCommands.Information:
+        # collect the values needed by both the text and json formats in one pass
+        creators = [f"{c.text} ({c.attrib['role']})" for c in creator_eles]
+        language_names = [c.text for c in language_eles if c.text]
+        # [(format name, [(part name, part duration, part size in kB), ...]), ...]
+        formats_parts = [
+            (
+                f.attrib["name"],
+                [
+                    (
+                        p.attrib["name"],
+                        p.attrib["duration"],
+                        math.ceil(int(p.attrib["filesize"]) / 1024),
+                    )
+                    for p in f.findall("Parts/*")
+                ],
+            )
+            for formats in root.findall("Formats")
+            for f in formats
+        ]
         if args.format == "text":
             logger.info(f'{"Title:":10} {colored(title, "blue")}')
             logger.info(
-                "{:10} {}".format(
-                    "Creators:",
-                    colored(
-                        ", ".join(
-                            [
-                                f"{c.text} ({c.attrib['role']})"
-                                for c in metadata.find("Creators") or []
-                            ]
-                        ),
-                        "blue",
-                    ),
-                )
+                "{:10} {}".format("Creators:", colored(", ".join(creators), "blue"))
             )
             logger.info(f"{'Publisher:':10} {publisher}")
             logger.info(f"{'Subjects:':10} {', '.join(subjects)}")
-            logger.info(
-                f"{'Languages:':10} {', '.join([c.text for c in metadata.find('Languages') or [] if c.text])}"
-            )
+            logger.info(f"{'Languages:':10} {', '.join(language_names)}")
             logger.info(f"{'Description:':10}\n{description}")
-            for formats in root.findall("Formats"):
-                for f in formats:
-                    logger.info(f"\n{'Format:':10} {f.attrib['name']}")
-                    parts = f.find("Parts") or []
-                    for p in parts:
-                        logger.info(
-                            f"* {p.attrib['name']} - {p.attrib['duration']} ({math.ceil(1.0 * int(p.attrib['filesize']) / 1024):,.0f}kB)"
-                        )
+            for format_name, parts_info in formats_parts:
+                logger.info(f"\n{'Format:':10} {format_name}")
+                for part_name, part_duration, part_size_kb in parts_info:
+                    logger.info(
+                        f"* {part_name} - {part_duration} ({part_size_kb:,.0f}kB)"
+                    )
 
         elif args.format == "json":
             result: Dict[str, Any] = {
                 "title": title,
-                "creators": [
-                    f"{c.text} ({c.attrib['role']})"
-                    for c in metadata.find("Creators") or []
-                ],
+                "creators": creators,
                 "publisher": publisher,
-                "subjects": [c.text for c in metadata.find("Subjects") or [] if c.text],
-                "languages": [
-                    c.text for c in metadata.find("Languages") or [] if c.text
-                ],
+                "subjects": subjects,
+                "languages": language_names,
                 "description": description,
                 "formats": [],
             }
 
-            for formats in root.findall("Formats"):
-                for f in formats:
-                    parts = []
-                    total_secs = 0
-                    for p in f.find("Parts") or []:
-                        part_duration = p.attrib["duration"]
-                        # part duration can look like '%M:%S.%f' or '%H:%M:%S.%f'
-                        total_secs = parse_duration_to_seconds(part_duration)
-                        parts.append(
-                            {
-                                "name": p.attrib["name"],
-                                "duration": part_duration,
-                                "filesize": f"{math.ceil(1.0 * int(p.attrib['filesize']) / 1024):,.0f}kB",
-                            }
-                        )
-                    result["formats"].append(
-                        {"format": f.attrib["name"], "parts": parts}
-                    )
-                    # in case there are multiple formats, only need to store it once
-                    if "total_duration" not in result:
-                        result["total_duration"] = {
-                            "total_minutes": round(total_secs / 60),
-                            "total_seconds": round(total_secs),
+            for format_name, parts_info in formats_parts:
+                parts = []
+                total_secs = 0
+                for part_name, part_duration, part_size_kb in parts_info:
+                    # part duration can look like '%M:%S.%f' or '%H:%M:%S.%f'
+                    total_secs = parse_duration_to_seconds(part_duration)
+                    parts.append(
+                        {
+                            "name": part_name,
+                            "duration": part_duration,
+                            "filesize": f"{part_size_kb:,.0f}kB",
                         }
+                    )
+                result["formats"].append({"format": format_name, "parts": parts})
+                # in case there are multiple formats, only need to store it once
+                if "total_duration" not in result:
+                    result["total_duration"] = {
+                        "total_minutes": round(total_secs / 60),
+                        "total_seconds": round(total_secs),
+                    }
 
             logger.info(json.dumps(result))
 
         return
 
-    session = init_session(max_retries=args.retries)
-
     # Download Book
     download_baseurl = ""
     download_parts = []
     for formats in root.findall("Formats"):
         for f in formats:
-            protocols = f.find("Protocols") or []
+            protocols = f.findall("Protocols/*")
             for p in protocols:
                 if p.attrib.get("method", "") != "download":
                     continue
                 download_baseurl = p.attrib["baseurl"]
                 break
-            parts = f.find("Parts") or []
+            parts = f.findall("Parts/*")
             for p in parts:
-                download_parts.append(p.attrib)
+                download_parts.append(dict(p.attrib))
     debug_meta["download_parts"] = download_parts
 
     logger.info(
@@ -307,13 +323,16 @@ def process_odm(
                 "magenta",
             ),
         )
-        if cleanup_odm_license and odm_file.exists():
-            try:
-                odm_file.unlink()
-            except Exception as e:  # pylint: disable=broad-except
-                logger.warning(f'Error deleting "{odm_file}": {str(e)}')
+        if cleanup_odm_license:
+            delete_file(odm_file, logger)
         return
 
+    # make sure the pool can keep a connection for each concurrent part download
+    session = init_session(
+        max_retries=args.retries,
+        pool_maxsize=max(32, args.download_parallelism),
+    )
+
     debug_filename = book_folder.joinpath("debug.json")
 
     cover_filename, cover_bytes = generate_cover(
@@ -335,8 +354,7 @@ def process_odm(
     media_id = root.attrib["id"]
 
     client_id = str(uuid.uuid1()).upper()
-    raw_hash = f"{client_id}|{OMC}|{OS}|ELOSNOC*AIDEM*EVIRDREVO"
-    m = hashlib.sha1(raw_hash.encode("utf-16-le"))
+    m = hashlib.sha1(client_id.encode("utf-16-le") + LICENSE_HASH_SUFFIX)
     license_hash = base64.b64encode(m.digest())
 
     # Extract license:
@@ -345,30 +363,28 @@ def process_odm(
     license_file = Path(args.download_dir, odm_file.with_suffix(".license").name)
     if license_file.exists():
         logger.warning(f"Already downloaded license file: {license_file}")
+        license_bytes = license_file.read_bytes()
     else:
         # download license file
-        params = OrderedDict(
-            [
-                ("MediaID", media_id),
-                ("ClientID", client_id),
-                ("OMC", OMC),
-                ("OS", OS),
-                ("Hash", license_hash),
-            ]
-        )
+        params = {
+            "MediaID": media_id,
+            "ClientID": client_id,
+            "OMC": OMC,
+            "OS": OS,
+            "Hash": license_hash,
+        }
 
         license_res = session.get(
             acquisition_url,
             params=params,
             headers={"User-Agent": UA},
             timeout=args.timeout,
-            stream=True,
         )
         try:
             license_res.raise_for_status()
-            with license_file.open("wb") as outfile:
-                for chunk in license_res.iter_content(1024):
-                    outfile.write(chunk)
+            # keep the (small) license in memory so that it's not read back from disk
+            license_bytes = license_res.content
+            license_file.write_bytes(license_bytes)
             logger.debug(f"Saved license file {license_file}")
 
         except HTTPError as he:
@@ -384,8 +400,7 @@ def process_odm(
             logger.error(f"ConnectionError: {str(ce)}")
             raise OdmpyRuntimeError("Connection Error while downloading license.")
 
-    license_xml_doc = ET.parse(license_file)
-    license_root = license_xml_doc.getroot()
+    license_root = ET.fromstring(license_bytes, XML_PARSER)
 
     ns = "{http://license.overdrive.com/2008/03/License.xsd}"
 
@@ -397,78 +412,58 @@ def process_odm(
     if not license_client_id:
         raise ValueError("Unable to find ClientID in License.SignedInfo")
 
-    with license_file.open("r", encoding="utf-8") as lic_file:
-        lic_file_contents = lic_file.read()
+    # normalise newlines as reading the file in text mode did previously
+    lic_file_contents = (
+        license_bytes.decode("utf-8").replace("\r\n", "\n").replace("\r", "\n")
+    )
 
     track_count = 0
     file_tracks: List[Dict] = []
     keep_cover = args.always_keep_cover
     audio_lengths_ms = []
     audio_bitrate = 0
-    for p in download_parts:
-        part_number = int(p["number"])
-        part_filename = book_folder.joinpath(
-            f"{slugify(f'{title} - Part {part_number:02d}', allow_unicode=True)}.mp3"
+    # same names as slugify(f"{title} - Part {part_number:02d}"),
+    # without slugifying the title again for every part
+    part_filename_prefix = slugify(f"{title} - Part", allow_unicode=True)
+    part_filenames = [
+        book_folder.joinpath(f"{part_filename_prefix}-{part_number:02d}.mp3")
+        for part_number in (int(p["number"]) for p in download_parts)
+    ]
+    # download the missing parts first, concurrently if requested
+    new_parts = [
+        PartDownload(
+            number=int(p["number"]),
+            url=f"{download_baseurl}/{p['filename']}",
+            file_size=int(p["filesize"]),
+            filename=part_filename,
         )
-        part_tmp_filename = part_filename.with_suffix(".part")
-        part_file_size = int(p["filesize"])
-        part_url_filename = p["filename"]
-        part_download_url = f"{download_baseurl}/{part_url_filename}"
+        for p, part_filename in zip(download_parts, part_filenames)
+        if not part_filename.exists()
+    ]
+    download_part_files(
+        session=session,
+        parts=new_parts,
+        headers={
+            "User-Agent": UA,
+            "ClientID": license_client_id,
+            "License": lic_file_contents,
+        },
+        timeout=args.timeout,
+        parallelism=args.download_parallelism,
+        hide_progress=args.hide_progress,
+        ffmpeg_loglevel=ffmpeg_loglevel,
+        logger=logger,
+        force_remux=args.force_remux,
+    )
+    new_part_filenames = {part.filename for part in new_parts}
+
+    for p, part_filename in zip(download_parts, part_filenames):
+        part_number = int(p["number"])
         part_markers = []
 
-        if part_filename.exists():
+        if part_filename not in new_part_filenames:
             logger.warning("Already saved %s", colored(str(part_filename), "magenta"))
         else:
-            try:
-                already_downloaded_len = 0
-                if part_tmp_filename.exists():
-                    already_downloaded_len = part_tmp_filename.stat().st_size
-
-                part_download_res = session.get(
-                    part_download_url,
-                    headers={
-                        "User-Agent": UA,
-                        "ClientID": license_client_id,
-                        "License": lic_file_contents,
-                        "Range": f"bytes={already_downloaded_len}-"
-                        if already_downloaded_len
-                        else None,
-                    },
-                    timeout=args.timeout,
-                    stream=True,
-                )
-                part_download_res.raise_for_status()
-
-                with tqdm.wrapattr(
-                    part_download_res.raw,
-                    "read",
-                    total=part_file_size,
-                    initial=already_downloaded_len,
-                    desc=f"Part {part_number:2d}",
-                    disable=args.hide_progress,
-                ) as res_raw:
-                    with part_tmp_filename.open(
-                        "ab" if already_downloaded_len else "wb"
-                    ) as outfile:
-                        shutil.copyfileobj(res_raw, outfile)
-
-                # try to remux file to remove mp3 lame tag errors
-                remux_mp3(
-                    part_tmp_filename=part_tmp_filename,
-                    part_filename=part_filename,
-                    ffmpeg_loglevel=ffmpeg_loglevel,
-                    logger=logger,
-                )
-
-            except HTTPError as he:
-                logger.error(f"HTTPError: {str(he)}")
-                logger.debug(he.response.content)
-                raise OdmpyRuntimeError("HTTP Error while downloading part file.")
-
-            except ConnectionError as ce:
-                logger.error(f"ConnectionError: {str(ce)}")
-                raise OdmpyRuntimeError("Connection Error while downloading part file.")
-
             # Save id3 info only on new download, ref #42
             # This also makes handling of part files consistent with merged files
             try:
@@ -495,7 +490,6 @@ def process_odm(
                     always_overwrite=args.overwrite_tags,
                     delimiter=args.tag_delimiter,
                 )
-                audiofile.tag.save(version=id3v2_version)
 
                 # Notes: Can't switch over to using eyed3 (audiofile.info.time_secs)
                 # because it is completely off by about 10-20 seconds.
@@ -509,16 +503,20 @@ def process_odm(
                 ):
                     if frame.description != "OverDrive MediaMarkers":
                         continue
-                    if frame.text:
-                        frame_text = re.sub(r"\s&\s", " &amp; ", frame.text)
+                    # don't bother parsing if there are no markers in the text
+                    if frame.text and "<Marker" in frame.text:
+                        frame_text = AMP_FIXUP_RE.sub(" &amp; ", frame.text)
                         try:
-                            tree = ET.fromstring(frame_text)
+                            tree = ET.fromstring(frame_text, XML_PARSER)
                         except UnicodeEncodeError:
                             tree = ET.fromstring(
-                                frame_text.encode("ascii", "ignore").decode("ascii")
+                                frame_text.encode("ascii", "ignore").decode("ascii"),
+                                XML_PARSER,
                             )
                         except ET.ParseError:
-                            tree = ET.fromstring(_patch_for_parse_error(frame_text))
+                            tree = ET.fromstring(
+                                _patch_for_parse_error(frame_text), XML_PARSER
+                            )
 
                         for marker in tree.iter("Marker"):  # type: ET.Element
                             marker_name = get_element_text(marker.find("Name")).strip()
@@ -566,6 +564,7 @@ def process_odm(
                         child_ids=[],
                         description="Table of Contents",
                     )
+                    chapters_by_id = {c.element_id: c for c in audiofile.tag.chapters}
 
                     for gm in generated_markers:
                         title_frameset = eyed3.id3.frames.FrameSet()
@@ -573,28 +572,32 @@ def process_odm(
                             eyed3.id3.frames.TITLE_FID, str(gm["text"])
                         )
 
-                        chap = audiofile.tag.chapters.set(
+                        chap = set_chapter(
+                            audiofile.tag,
+                            chapters_by_id,
                             str(gm["id"]).encode("ascii"),
-                            times=(gm["start_time"], gm["end_time"]),
+                            times=(int(gm["start_time"]), int(gm["end_time"])),
                             sub_frames=title_frameset,
                         )
                         toc.child_ids.append(chap.element_id)
-                        start_time = datetime.timedelta(
-                            milliseconds=float(gm["start_time"])
-                        )
-                        end_time = datetime.timedelta(
-                            milliseconds=float(gm["end_time"])
-                        )
-                        logger.debug(
-                            'Added chap tag => %s: %s-%s "%s" to "%s"',
-                            colored(str(gm["id"]), "cyan"),
-                            start_time,
-                            end_time,
-                            colored(str(gm["text"]), "cyan"),
-                            colored(str(part_filename), "blue"),
-                        )
+                        if logger.isEnabledFor(logging.DEBUG):
+                            start_time = datetime.timedelta(
+                                milliseconds=float(gm["start_time"])
+                            )
+                            end_time = datetime.timedelta(
+                                milliseconds=float(gm["end_time"])
+                            )
+                            logger.debug(
+                                'Added chap tag => %s: %s-%s "%s" to "%s"',
+                                colored(str(gm["id"]), "cyan"),
+                                start_time,
+                                end_time,
+                                colored(str(gm["text"]), "cyan"),
+                                colored(str(part_filename), "blue"),
+                            )
 
-                    audiofile.tag.save(version=id3v2_version)
+                # save the tags and chapters in a single write
+                audiofile.tag.save(version=id3v2_version)
 
             except Exception as e:  # pylint: disable=broad-except
                 logger.warning(
@@ -602,6 +605,9 @@ def process_odm(
                 )
                 keep_cover = True
 
+            if not args.merge_output:
+                # part is final, it won't be read again in this run
+                drop_file_cache(part_filename)
             logger.info('Saved "%s"', colored(str(part_filename), "magenta"))
 
         file_tracks.append(
@@ -661,13 +667,11 @@ def process_odm(
             args.overwrite_tags or not audiofile.tag.table_of_contents
         ):
             merged_markers: List[Dict[str, Union[str, int]]] = []
+            # running total of the tracks' lengths, i.e. each track's start offset
+            tracks_offsets_ms = [0] + list(accumulate(audio_lengths_ms))
             for i, f in enumerate(file_tracks):
-                prev_tracks_len_ms = (
-                    0 if i == 0 else reduce(lambda x, y: x + y, audio_lengths_ms[0:i])
-                )
-                this_track_endtime_ms = int(
-                    reduce(lambda x, y: x + y, audio_lengths_ms[0 : i + 1])
-                )
+                prev_tracks_len_ms = tracks_offsets_ms[i]
+                this_track_endtime_ms = int(tracks_offsets_ms[i + 1])
                 file_markers = f["markers"]
                 for j, file_marker in enumerate(file_markers):
                     merged_markers.append(
@@ -697,26 +701,32 @@ def process_odm(
                 child_ids=[],
                 description="Table of Contents",
             )
+            chapters_by_id = {c.element_id: c for c in audiofile.tag.chapters}
 
             for mm in merged_markers:  # type: Dict[str, Union[str, int]]
                 title_frameset = eyed3.id3.frames.FrameSet()
                 title_frameset.setTextFrame(eyed3.id3.frames.TITLE_FID, mm["text"])
-                chap = audiofile.tag.chapters.set(
+                chap = set_chapter(
+                    audiofile.tag,
+                    chapters_by_id,
                     str(mm["id"]).encode("ascii"),
-                    times=(mm["start_time"], mm["end_time"]),
+                    times=(int(mm["start_time"]), int(mm["end_time"])),
                     sub_frames=title_frameset,
                 )
                 toc.child_ids.append(chap.element_id)
-                start_time = datetime.timedelta(milliseconds=float(mm["start_time"]))
-                end_time = datetime.timedelta(milliseconds=float(mm["end_time"]))
-                logger.debug(
-                    'Added chap tag => %s: %s-%s "%s" to "%s"',
-                    colored(str(mm["id"]), "cyan"),
-                    start_time,
-                    end_time,
-                    colored(str(mm["text"]), "cyan"),
-                    colored(str(book_filename), "blue"),
-                )
+                if logger.isEnabledFor(logging.DEBUG):
+                    start_time = datetime.timedelta(
+                        milliseconds=float(mm["start_time"])
+                    )
+                    end_time = datetime.timedelta(milliseconds=float(mm["end_time"]))
+                    logger.debug(
+                        'Added chap tag => %s: %s-%s "%s" to "%s"',
+                        colored(str(mm["id"]), "cyan"),
+                        start_time,
+                        end_time,
+                        colored(str(mm["text"]), "cyan"),
+                        colored(str(book_filename), "blue"),
+                    )
 
         audiofile.tag.save(version=id3v2_version)
 
@@ -745,26 +755,18 @@ def process_odm(
                 logger=logger,
             )
 
+        drop_file_cache(
+            book_filename if args.merge_format == "mp3" else book_m4b_filename
+        )
+
         if not args.keep_mp3:
-            for f in file_tracks:
-                try:
-                    f["file"].unlink()
-                except Exception as e:  # pylint: disable=broad-except
-                    logger.warning(f'Error deleting "{f["file"]}": {str(e)}')
+            delete_files([f["file"] for f in file_tracks], logger)
 
     if cleanup_odm_license:
-        for target_file in [odm_file, license_file]:
-            if target_file and target_file.exists():
-                try:
-                    target_file.unlink()
-                except Exception as e:  # pylint: disable=broad-except
-                    logger.warning(f'Error deleting "{target_file}": {str(e)}')
-
-    if not keep_cover and cover_filename.exists():
-        try:
-            cover_filename.unlink()
-        except Exception as e:  # pylint: disable=broad-except
-            logger.warning(f'Error deleting "{cover_filename}": {str(e)}')
+        delete_files([odm_file, license_file], logger)
+
+    if not keep_cover:
+        delete_file(cover_filename, logger)
 
     if args.generate_opf:
         if args.merge_output:
@@ -783,7 +785,10 @@ def process_odm(
             else:
                 reserve_id = mobj.group("reserve_id")
                 od_client = OverDriveClient(
-                    user_agent=USER_AGENT, timeout=args.timeout, retry=args.retries
+                    user_agent=USER_AGENT,
+                    timeout=args.timeout,
+                    retry=args.retries,
+                    session=session,
                 )
                 media_info = od_client.media(reserve_id)
                 create_opf(
@@ -805,8 +810,8 @@ def process_odm(
             logger.info("Already saved %s", colored(str(opf_file_path), "magenta"))
 
     if args.write_json:
-        with debug_filename.open("w", encoding="utf-8") as outfile:
-            json.dump(debug_meta, outfile, indent=2)
+        with debug_filename.open("wb") as outfile:
+            outfile.write(json_dumps_bytes(debug_meta, indent=True))
 
 
 def process_odm_return(args: argparse.Namespace, logger: logging.Logger) -> None:
@@ -817,7 +822,7 @@ def process_odm_return(args: argparse.Namespace, logger: logging.Logger) -> None
     :param args:
     :return:
     """
-    xml_doc = ET.parse(args.odm_file)
+    xml_doc = ET.parse(args.odm_file, XML_PARSER)
     root = xml_doc.getroot()
 
     logger.info(f"Returning {args.odm_file} ...")
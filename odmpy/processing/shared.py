@@ -18,10 +18,14 @@
 
 import argparse
 import logging
+import os
+import shutil
 import subprocess
 import xml.etree.ElementTree as ET
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
-from typing import Optional, Dict, List, Tuple
+from queue import Queue
+from typing import Optional, Dict, List, NamedTuple, Tuple, Callable
 from urllib.parse import urlparse
 
 import eyed3  # type: ignore[import]
@@ -29,11 +33,15 @@ import requests
 from eyed3.utils import art  # type: ignore[import]
 from iso639 import Lang  # type: ignore[import]
 from requests.adapters import HTTPAdapter, Retry
+from requests.exceptions import HTTPError, ConnectionError
 from termcolor import colored
+from tqdm import tqdm
 
+from .. import cache
 from ..constants import PERFORMER_FID, LANGUAGE_FID
 from ..errors import OdmpyRuntimeError
-from ..libby import USER_AGENT, LibbyFormats, LibbyClient
+from ..libby import USER_AGENT, LibbyFormats, LibbyClient, DOWNLOAD_CHUNK_SIZE
+from ..overdrive import OverDriveClient
 from ..utils import slugify, sanitize_path, is_windows
 
 
@@ -41,11 +49,24 @@ from ..utils import slugify, sanitize_path, is_windows
 # Shared functions across processing for diff loan types
 #
 
+# title metadata rarely changes after release
+MEDIA_INFO_CACHE_TTL = 30 * 24 * 60 * 60
 
-def init_session(max_retries: int = 0) -> requests.Session:
+
+class PartDownload(NamedTuple):
+    number: int
+    url: str
+    file_size: int
+    filename: Path
+
+
+def init_session(max_retries: int = 0, pool_maxsize: int = 32) -> requests.Session:
     session = requests.Session()
     custom_adapter = HTTPAdapter(
-        max_retries=Retry(total=max_retries, backoff_factor=0.1)
+        # larger pool so that connections are kept when fetching concurrently
+        pool_connections=16,
+        pool_maxsize=pool_maxsize,
+        max_retries=Retry(total=max_retries, backoff_factor=0.1),
     )
     for prefix in ("http://", "https://"):
         session.mount(prefix, custom_adapter)
@@ -161,6 +182,39 @@ def generate_names(
     return book_folder, book_filename
 
 
+def set_chapter(
+    tag: eyed3.id3.Tag,
+    chapters_by_id: Dict[bytes, eyed3.id3.frames.ChapterFrame],
+    element_id: bytes,
+    times: Tuple[int, int],
+    sub_frames: eyed3.id3.frames.FrameSet,
+) -> eyed3.id3.frames.ChapterFrame:
+    """
+    Add or update a chapter frame, like ``tag.chapters.set()`` but using an
+    index of the existing chapters instead of scanning all chapter frames
+    on every call.
+
+    :param tag:
+    :param chapters_by_id: Existing chapters by element ID, updated with the new chapter
+    :param element_id:
+    :param times: Start and end time in milliseconds
+    :param sub_frames:
+    :return:
+    """
+    chap = chapters_by_id.get(element_id)
+    if chap is not None:
+        chap.times, chap.offsets = times, (None, None)
+        chap.sub_frames = sub_frames
+        return chap
+
+    chap = eyed3.id3.frames.ChapterFrame(
+        element_id=element_id, times=times, sub_frames=sub_frames
+    )
+    tag.frame_set[eyed3.id3.frames.CHAPTER_FID] = chap
+    chapters_by_id[element_id] = chap
+    return chap
+
+
 def write_tags(
     audiofile: eyed3.core.AudioFile,
     title: str,
@@ -267,6 +321,26 @@ def write_tags(
         audiofile.tag.user_text_frames.set(isbn, "ISBN")
 
 
+def get_media_info(
+    od_client: OverDriveClient, title_id: str, cache_folder: Optional[Path]
+) -> Dict:
+    """
+    Get a title's media info, cached across runs if a cache folder is available
+
+    :param od_client:
+    :param title_id:
+    :param cache_folder:
+    :return:
+    """
+    cache_key = f"media-{title_id}"
+    media_info = cache.get(cache_folder, cache_key) if cache_folder else None
+    if not media_info:
+        media_info = od_client.media(title_id)
+        if cache_folder:
+            cache.put(cache_folder, cache_key, media_info, MEDIA_INFO_CACHE_TTL)
+    return media_info
+
+
 def get_best_cover_url(loan: Dict) -> Optional[str]:
     """
     Extracts the highest resolution cover image for the loan
@@ -498,10 +572,97 @@ def convert_to_m4b(
 
     temp_book_m4b_filename.rename(book_m4b_filename)
     logger.info('Merged files into "%s"', colored(str(book_m4b_filename), "magenta"))
+    delete_file(book_filename, logger)
+
+
+def _crc16(data: bytes) -> int:
+    """
+    CRC-16 (poly 0x8005, reflected) as used by the LAME info tag
+
+    :param data:
+    :return:
+    """
+    crc = 0
+    for b in data:
+        crc ^= b
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+    return crc
+
+
+def _needs_remux(file_path: Path) -> bool:
+    """
+    Check if an mp3 file needs to be remuxed.
+    The remux is only skipped if the first MPEG frame immediately follows the
+    ID3v2 tag and is a Xing/Info frame whose byte count matches the audio
+    in the file, so that durations worked out from it are correct.
+    Any LAME info tag must also have a valid CRC.
+
+    :param file_path:
+    :return:
+    """
     try:
-        book_filename.unlink()
-    except Exception as e:  # pylint: disable=broad-except
-        logger.warning(f'Error deleting "{book_filename}": {str(e)}')
+        with file_path.open("rb") as f:
+            header = f.read(10)
+            frame_offset = 0
+            if len(header) == 10 and header[:3] == b"ID3":
+                # synchsafe tag size, excluding the 10-byte header
+                tag_size = (
+                    (header[6] & 0x7F) << 21
+                    | (header[7] & 0x7F) << 14
+                    | (header[8] & 0x7F) << 7
+                    | (header[9] & 0x7F)
+                )
+                frame_offset = 10 + tag_size + (10 if header[5] & 0x10 else 0)
+            f.seek(frame_offset)
+            frame = f.read(4096)
+            # exclude any trailing ID3v1 tag from the audio size
+            file_size = f.seek(0, os.SEEK_END)
+            if file_size >= 128:
+                f.seek(-128, os.SEEK_END)
+                if f.read(3) == b"TAG":
+                    file_size -= 128
+    except OSError:
+        return True
+
+    if len(frame) < 4 or frame[0] != 0xFF or (frame[1] & 0xE0) != 0xE0:
+        return True
+    version = (frame[1] >> 3) & 0x03  # 3: MPEG1, 2: MPEG2, 0: MPEG2.5
+    layer = (frame[1] >> 1) & 0x03  # 1: Layer III
+    if version == 1 or layer != 1:
+        return True
+    mono = (frame[3] >> 6) & 0x03 == 3
+    if version == 3:
+        side_info_size = 17 if mono else 32
+    else:
+        side_info_size = 9 if mono else 17
+
+    xing_offset = 4 + side_info_size
+    if frame[xing_offset : xing_offset + 4] not in (b"Xing", b"Info"):
+        # no info frame to check the stream against
+        return True
+    flags = int.from_bytes(frame[xing_offset + 4 : xing_offset + 8], "big")
+    if not flags & 0x02:
+        # no byte count
+        return True
+    bytes_offset = xing_offset + 8 + (4 if flags & 0x01 else 0)
+    stream_size = int.from_bytes(frame[bytes_offset : bytes_offset + 4], "big")
+    if stream_size != file_size - frame_offset:
+        return True
+    lame_offset = xing_offset + 8
+    for flag, size in ((0x01, 4), (0x02, 4), (0x04, 100), (0x08, 4)):
+        if flags & flag:
+            lame_offset += size
+    if frame[lame_offset : lame_offset + 4] not in (b"LAME", b"Lavf", b"Lavc"):
+        return False
+    # the tag crc is the last 2 bytes of the 36-byte LAME tag,
+    # and covers the frame up to it
+    crc_offset = lame_offset + 34
+    if len(frame) < crc_offset + 2:
+        return True
+    return _crc16(frame[:crc_offset]) != int.from_bytes(
+        frame[crc_offset : crc_offset + 2], "big"
+    )
 
 
 def remux_mp3(
@@ -509,16 +670,24 @@ def remux_mp3(
     part_filename: Path,
     ffmpeg_loglevel: str,
     logger: logging.Logger,
+    force: bool = False,
 ) -> None:
     """
-    Try to remux file to remove mp3 lame tag errors
+    Try to remux file to remove mp3 lame tag errors.
+    The remux is skipped if the file does not need it, unless forced.
 
     :param part_tmp_filename:
     :param part_filename:
     :param ffmpeg_loglevel:
     :param logger:
+    :param force: Always remux
     :return:
     """
+    if not force and not _needs_remux(part_tmp_filename):
+        logger.debug('Skipped remux for "%s"', part_filename)
+        part_tmp_filename.replace(part_filename)
+        return
+
     cmd = [
         "ffmpeg",
         "-y",
@@ -547,6 +716,255 @@ def remux_mp3(
         part_tmp_filename.rename(part_filename)
 
 
+def download_part_file(
+    session: requests.Session,
+    part: PartDownload,
+    headers: Dict[str, str],
+    timeout: int,
+    hide_progress: bool,
+    logger: logging.Logger,
+    progress_position: Optional[int] = None,
+) -> Path:
+    """
+    Download an audiobook part file to a temporary .part file, resuming
+    from a previous partial download if available.
+    The part's ETag/Last-Modified is kept alongside the .part file so that
+    a resume only continues if the remote file has not changed.
+
+    :param session:
+    :param part:
+    :param headers:
+    :param timeout:
+    :param hide_progress:
+    :param logger:
+    :param progress_position: Line offset of the progress bar, for concurrent downloads
+    :return: The temporary .part file path
+    """
+    part_tmp_filename = part.filename.with_suffix(".part")
+    part_validator_filename = part.filename.with_suffix(".part.etag")
+    try:
+        try:
+            already_downloaded_len = part_tmp_filename.stat().st_size
+        except FileNotFoundError:
+            already_downloaded_len = 0
+        validator = None
+        if already_downloaded_len:
+            try:
+                validator = part_validator_filename.read_text(encoding="utf-8")
+            except FileNotFoundError:
+                pass
+
+        part_download_res = session.get(
+            part.url,
+            headers={
+                **headers,
+                # byte ranges must refer to the stored file, not a compressed body
+                "Accept-Encoding": "identity",
+                "Range": f"bytes={already_downloaded_len}-"
+                if already_downloaded_len
+                else None,
+                # the server sends the whole file instead if it has changed
+                "If-Range": validator,
+            },
+            timeout=timeout,
+            stream=True,
+        )
+        part_download_res.raise_for_status()
+        # in case the server compresses the response
+        part_download_res.raw.decode_content = True
+        if already_downloaded_len and part_download_res.status_code != 206:
+            # not a partial response, so start over instead of appending
+            logger.debug("Unable to resume %s, downloading again", part_tmp_filename)
+            already_downloaded_len = 0
+        if not already_downloaded_len:
+            res_headers = part_download_res.headers
+            validator = res_headers.get("ETag") or res_headers.get("Last-Modified")
+            if validator:
+                part_validator_filename.write_text(validator, encoding="utf-8")
+
+        with tqdm.wrapattr(
+            part_download_res.raw,
+            "read",
+            total=part.file_size,
+            initial=already_downloaded_len,
+            desc=f"Part {part.number:2d}",
+            disable=hide_progress,
+            position=progress_position,
+        ) as res_raw:
+            with part_tmp_filename.open(
+                "ab" if already_downloaded_len else "wb"
+            ) as outfile:
+                if hasattr(os, "posix_fadvise"):
+                    try:
+                        # the file is only ever written/read front to back
+                        os.posix_fadvise(
+                            outfile.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL
+                        )
+                    except OSError:
+                        pass
+                shutil.copyfileobj(res_raw, outfile, length=DOWNLOAD_CHUNK_SIZE)
+
+        try:
+            part_validator_filename.unlink()
+        except FileNotFoundError:
+            pass
+        return part_tmp_filename
+
+    except HTTPError as he:
+        logger.error(f"HTTPError: {str(he)}")
+        logger.debug(he.response.content)
+        raise OdmpyRuntimeError("HTTP Error while downloading part file.")
+
+    except ConnectionError as ce:
+        logger.error(f"ConnectionError: {str(ce)}")
+        raise OdmpyRuntimeError("Connection Error while downloading part file.")
+
+
+def download_part_files(
+    session: requests.Session,
+    parts: List[PartDownload],
+    headers: Dict[str, str],
+    timeout: int,
+    parallelism: int,
+    hide_progress: bool,
+    ffmpeg_loglevel: str,
+    logger: logging.Logger,
+    on_part_saved: Optional[Callable[[PartDownload], None]] = None,
+    force_remux: bool = False,
+) -> None:
+    """
+    Download and remux audiobook part files, concurrently if parallelism > 1.
+    Each part is remuxed in the background as soon as it is downloaded so that
+    ffmpeg runs while the next part is being fetched.
+    ``on_part_saved`` is then called for the part from a single background thread,
+    so that tagging can overlap with the downloads while never running concurrently
+    because eyed3 is not thread-safe.
+
+    :param session:
+    :param parts:
+    :param headers:
+    :param timeout:
+    :param parallelism: Max number of concurrent downloads
+    :param hide_progress:
+    :param ffmpeg_loglevel:
+    :param logger:
+    :param on_part_saved: Called with each part once it is saved, e.g. to tag it
+    :param force_remux: Always remux, see :func:`remux_mp3`
+    :return:
+    """
+    with ThreadPoolExecutor(max_workers=1) as saved_executor, ThreadPoolExecutor(
+        max_workers=max(1, parallelism)
+    ) as remux_executor:
+        # free progress bar lines, so that concurrent bars don't overwrite each other
+        progress_positions: "Queue[Optional[int]]" = Queue()
+        for i in range(max(1, parallelism)):
+            progress_positions.put(i if parallelism > 1 else None)
+
+        def _download(part: PartDownload) -> Future:
+            progress_position = progress_positions.get()
+            try:
+                part_tmp_filename = download_part_file(
+                    session=session,
+                    part=part,
+                    headers=headers,
+                    timeout=timeout,
+                    hide_progress=hide_progress,
+                    logger=logger,
+                    progress_position=progress_position,
+                )
+            finally:
+                progress_positions.put(progress_position)
+            return remux_executor.submit(_remux, part, part_tmp_filename)
+
+        def _remux(part: PartDownload, part_tmp_filename: Path) -> Optional[Future]:
+            # try to remux file to remove mp3 lame tag errors
+            remux_mp3(
+                part_tmp_filename=part_tmp_filename,
+                part_filename=part.filename,
+                ffmpeg_loglevel=ffmpeg_loglevel,
+                logger=logger,
+                force=force_remux,
+            )
+            if not on_part_saved:
+                return None
+            return saved_executor.submit(on_part_saved, part)
+
+        if parallelism <= 1 or len(parts) <= 1:
+            remux_futures = [_download(part) for part in parts]
+        else:
+            with ThreadPoolExecutor(
+                max_workers=min(parallelism, len(parts))
+            ) as executor:
+                remux_futures = list(executor.map(_download, parts))
+
+        # wait for the remuxes and callbacks, raising any error here
+        for remux_future in remux_futures:
+            saved_future = remux_future.result()
+            if saved_future:
+                saved_future.result()
+
+
+def delete_file(file_path: Path, logger: logging.Logger) -> None:
+    """
+    Delete a file, ignoring it if it does not exist and logging any other error
+
+    :param file_path:
+    :param logger:
+    :return:
+    """
+    try:
+        file_path.unlink()
+    except FileNotFoundError:
+        pass
+    except Exception as e:  # pylint: disable=broad-except
+        logger.warning(f'Error deleting "{file_path}": {str(e)}')
+
+
+def delete_files(
+    file_paths: List[Path], logger: logging.Logger, max_workers: int = 8
+) -> None:
+    """
+    Delete multiple files, see :func:`delete_file`.
+    Files are only deleted concurrently when there are more than ``max_workers``
+    of them, since a thread pool is slower than a plain loop for a few files.
+
+    :param file_paths:
+    :param logger:
+    :param max_workers:
+    :return:
+    """
+    if len(file_paths) <= max_workers:
+        for file_path in file_paths:
+            delete_file(file_path, logger)
+        return
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # consume the results so that any unexpected error is raised here
+        list(executor.map(lambda f: delete_file(f, logger), file_paths))
+
+
+def drop_file_cache(file_path: Path) -> None:
+    """
+    Advise the OS that the cached pages for a finished file can be released
+    so that large audiobook downloads don't crowd out the page cache.
+    Does nothing on platforms without posix_fadvise, e.g. Windows.
+
+    :param file_path:
+    :return:
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        fd = os.open(file_path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
 def extract_authors_from_openbook(openbook: Dict) -> List[str]:
     """
     Extract list of author names from openbook
@@ -555,13 +973,27 @@ def extract_authors_from_openbook(openbook: Dict) -> List[str]:
     :return:
     """
     creators = openbook.get("creator", [])
+    creators_by_role = group_creators_by_role(creators)
     return (
-        [c["name"] for c in creators if c.get("role", "") == "author"]
-        or [c["name"] for c in creators if c.get("role", "") == "editor"]
+        creators_by_role.get("author")
+        or creators_by_role.get("editor")
         or [c["name"] for c in creators]
     )
 
 
+def group_creators_by_role(creators: List[Dict]) -> Dict[str, List[str]]:
+    """
+    Group openbook creator names by role in a single pass
+
+    :param creators:
+    :return:
+    """
+    creators_by_role: Dict[str, List[str]] = {}
+    for c in creators:
+        creators_by_role.setdefault(c.get("role", ""), []).append(c["name"])
+    return creators_by_role
+
+
 def extract_asin(formats: List[Dict]) -> str:
     """
     Extract Amazon's ASIN from media_info["formats"]
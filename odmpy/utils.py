@@ -16,17 +16,41 @@
 # along with odmpy.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import json
 import os
 import platform
 import re
 import unicodedata
 import xml.etree.ElementTree as ET
+from functools import lru_cache
 from mimetypes import guess_type
 from pathlib import Path
-from typing import Optional
+from typing import Any, Callable, Optional, Union
 
 from mutagen.mp3 import MP3  # type: ignore[import]
 
+try:
+    # optional, faster json parsing and serialising
+    import orjson
+
+    _json_loads: Callable[[Union[bytes, str]], Any] = orjson.loads
+
+    def _json_dumps_bytes(obj: Any, indent: bool = False) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else None)
+
+except ImportError:  # pragma: no cover
+    _json_loads = json.loads
+
+    def _json_dumps_bytes(obj: Any, indent: bool = False) -> bytes:
+        # match the orjson output
+        return json.dumps(
+            obj,
+            indent=2 if indent else None,
+            separators=None if indent else (",", ":"),
+            ensure_ascii=False,
+        ).encode("utf-8")
+
+
 #
 # Small utility type functions used across the board
 #
@@ -35,6 +59,8 @@ TIMESTAMP_RE = re.compile(
     r"^((?P<hr>[0-9]+):)?(?P<min>[0-9]+):(?P<sec>[0-9]+)(\.(?P<ms>[0-9]+))?$"
 )
 ILLEGAL_WIN_PATH_CHARS_RE = re.compile(r'[<>:"/\\|?*]')
+SLUGIFY_INVALID_CHARS_RE = re.compile(r"[^\w\s-]")
+SLUGIFY_SEPARATORS_RE = re.compile(r"[-\s]+")
 MIMETYPE_MAP = {
     ".xhtml": "application/xhtml+xml",
     ".html": "text/html",
@@ -126,9 +152,10 @@ def get_element_text(ele: Optional[ET.Element]) -> str:
     :param ele:
     :return:
     """
-    if (ele is not None) and ele.text:
-        return ele.text or ""
-    return ""
+    if ele is None:
+        return ""
+    # read .text once, lxml builds a new str on every access
+    return ele.text or ""
 
 
 def parse_duration_to_milliseconds(text: str) -> int:
@@ -173,6 +200,7 @@ def mp3_duration_ms(filename: Path) -> int:
 
 
 # From django
+@lru_cache(maxsize=256)
 def slugify(value: str, allow_unicode: bool = False) -> str:
     """
     Convert to ASCII if 'allow_unicode' is False. Convert spaces to hyphens.
@@ -181,10 +209,31 @@ def slugify(value: str, allow_unicode: bool = False) -> str:
     """
     if allow_unicode:
         value = unicodedata.normalize("NFKC", value)
-        value = re.sub(r"[^\w\s-]", "", value, flags=re.U).strip().lower()
-        return re.sub(r"[-\s]+", "-", value, flags=re.U)
+        value = SLUGIFY_INVALID_CHARS_RE.sub("", value).strip().lower()
+        return SLUGIFY_SEPARATORS_RE.sub("-", value)
     value = (
         unicodedata.normalize("NFKD", value).encode("ascii", "ignore").decode("ascii")
     )
-    value = re.sub(r"[^\w\s-]", "", value).strip().lower()
-    return re.sub(r"[-\s]+", "-", value)
+    value = SLUGIFY_INVALID_CHARS_RE.sub("", value).strip().lower()
+    return SLUGIFY_SEPARATORS_RE.sub("-", value)
+
+
+def json_loads(content: Union[bytes, str]) -> Any:
+    """
+    Deserialise json, using orjson if available.
+
+    :param content:
+    :return:
+    """
+    return _json_loads(content)
+
+
+def json_dumps_bytes(obj: Any, indent: bool = False) -> bytes:
+    """
+    Serialise to utf-8 encoded json, using orjson if available.
+
+    :param obj:
+    :param indent: Pretty print with an indent of 2 spaces
+    :return:
+    """
+    return _json_dumps_bytes(obj, indent)
@@ -32,7 +32,7 @@ install_requires = [
     "requests>=2.28.0",
     "eyed3>=0.9.7",
     "mutagen>=1.46.0",
-    "termcolor>=2.0.0",
+    "termcolor>=2.1.0",
     "tqdm>=4.63.0",
     "beautifulsoup4>=4.11.0",
     "lxml>=4.9.0",
@@ -55,6 +55,7 @@ setup(
     },
     python_requires=">=3.7",
     install_requires=install_requires,
+    extras_require={"orjson": ["orjson>=3.8.0"]},
     include_package_data=True,
     platforms="any",
     long_description=__long_description__,
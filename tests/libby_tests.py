@@ -8,6 +8,7 @@ from http import HTTPStatus
 import responses
 from responses import matchers
 
+from odmpy import cache
 from odmpy.libby import (
     LibbyClient,
     parse_toc,
@@ -15,6 +16,7 @@ from odmpy.libby import (
     ChapterMarker,
     parse_part_path,
     LibbyFormats,
+    LibbyMediaTypes,
 )
 from odmpy.libby_errors import ClientBadRequestError, ClientError
 from tests.base import BaseTestCase, is_on_ci
@@ -534,6 +536,15 @@ class LibbyClientTests(BaseTestCase):
         client = LibbyClient(settings_folder=str(settings_folder))
         self.assertTrue(client.has_sync_code())
 
+    def test_clear_settings(self):
+        settings_folder = self._generate_fake_settings()
+        client = LibbyClient(settings_folder=str(settings_folder))
+        cache.put(client.cache_folder, "test", {"a": 1}, 60)
+        client.clear_settings()
+        self.assertFalse(client.has_chip())
+        self.assertFalse(settings_folder.joinpath("libby.json").exists())
+        self.assertIsNone(cache.get(client.cache_folder, "test"))
+
     def test_string_enum(self):
         self.assertEqual(f"{LibbyFormats.AudioBookMP3}", "audiobook-mp3")
         self.assertEqual(str(LibbyFormats.AudioBookMP3), "audiobook-mp3")
@@ -544,6 +555,39 @@ class LibbyClientTests(BaseTestCase):
         self.assertEqual(LibbyFormats.AudioBookMP3, "audiobook-mp3")
         self.assertEqual(LibbyFormats.AudioBookMP3, LibbyFormats("audiobook-mp3"))
 
+    def test_get_downloadable_media_types(self):
+        self.assertEqual(
+            LibbyClient.get_downloadable_media_types(
+                {
+                    "formats": [
+                        {"id": LibbyFormats.EBookKindle},
+                        {"id": LibbyFormats.EBookOverdrive},
+                        {"id": LibbyFormats.EBookEPubAdobe},
+                        {"id": LibbyFormats.EBookEPubOpen},
+                    ]
+                }
+            ),
+            {LibbyMediaTypes.EBook},
+        )
+        self.assertEqual(
+            LibbyClient.get_downloadable_media_types(
+                {"formats": [{"id": LibbyFormats.AudioBookMP3}]}
+            ),
+            {LibbyMediaTypes.Audiobook},
+        )
+        self.assertEqual(
+            LibbyClient.get_downloadable_media_types(
+                {"formats": [{"id": LibbyFormats.MagazineOverDrive}]}
+            ),
+            {LibbyMediaTypes.Magazine},
+        )
+        self.assertEqual(
+            LibbyClient.get_downloadable_media_types(
+                {"formats": [{"id": LibbyFormats.EBookKindle}]}
+            ),
+            set(),
+        )
+
     def test_get_loan_format(self):
         with self.assertRaises(ValueError) as context:
             LibbyClient.get_loan_format(
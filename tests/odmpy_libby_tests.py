@@ -1,3 +1,4 @@
+import io
 import json
 import os.path
 import time
@@ -645,7 +646,7 @@ class OdmpyLibbyTests(BaseTestCase):
         with self.test_data_dir.joinpath("ebook", "dummy.epub").open("rb") as a:
             opener_open = MagicMock()
             opener_open.getcode.return_value = 200
-            opener_open.read.return_value = a.read()
+            opener_open.read.side_effect = io.BytesIO(a.read()).read
             mock_opener.return_value = opener_open
 
             test_folder = "test"
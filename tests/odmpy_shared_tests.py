@@ -1,6 +1,10 @@
 import argparse
 from functools import cmp_to_key
 
+import responses
+from responses import matchers
+
+from odmpy.overdrive import OverDriveClient
 from odmpy.processing import shared
 from odmpy.processing.ebook import _sort_title_contents
 from tests.base import BaseTestCase
@@ -32,6 +36,19 @@ class ProcessingSharedTests(BaseTestCase):
         }
         self.assertEqual(shared.extract_authors_from_openbook(openbook_mock), ["C"])
 
+    def test_group_creators_by_role(self):
+        creators = [
+            {"name": "A", "role": "author"},
+            {"name": "N1", "role": "narrator"},
+            {"name": "A2", "role": "author"},
+            {"name": "N2", "role": "narrator"},
+            {"name": "X"},
+        ]
+        self.assertEqual(
+            shared.group_creators_by_role(creators),
+            {"author": ["A", "A2"], "narrator": ["N1", "N2"], "": ["X"]},
+        )
+
     def test_extract_isbn(self):
         formats = [
             {
@@ -141,3 +158,125 @@ class ProcessingSharedTests(BaseTestCase):
                 {"url": "http://localhost/assets/4.css"},
             ],
         )
+
+    @responses.activate
+    def test_get_media_info(self):
+        responses.get(
+            "https://thunder.api.overdrive.com/v2/media/9999999?x-client-id=dewey",
+            json={"id": "9999999", "title": "Test"},
+        )
+        od_client = OverDriveClient()
+        cache_folder = self.test_downloads_dir.joinpath("cache")
+        for _ in range(2):
+            media_info = shared.get_media_info(od_client, "9999999", cache_folder)
+            self.assertEqual(media_info, {"id": "9999999", "title": "Test"})
+        # second lookup is from the cache
+        self.assertEqual(len(responses.calls), 1)
+
+    def test_needs_remux(self):
+        mp3_file = self.test_data_dir.joinpath("audiobook", "book.mp3")
+        self.assertFalse(shared._needs_remux(mp3_file))
+
+        # corrupt the LAME tag so that the crc no longer matches
+        mp3_bytes = bytearray(mp3_file.read_bytes())
+        lame_offset = mp3_bytes.index(b"LAME")
+        mp3_bytes[lame_offset + 20] ^= 0xFF
+        bad_mp3_file = self.test_downloads_dir.joinpath("bad.mp3")
+        bad_mp3_file.write_bytes(mp3_bytes)
+        self.assertTrue(shared._needs_remux(bad_mp3_file))
+
+        # the info frame's byte count no longer matches the audio
+        bad_mp3_file.write_bytes(mp3_file.read_bytes()[:-1024])
+        self.assertTrue(shared._needs_remux(bad_mp3_file))
+
+        bad_mp3_file.write_bytes(b"not an mp3")
+        self.assertTrue(shared._needs_remux(bad_mp3_file))
+        bad_mp3_file.unlink()
+
+    @responses.activate
+    def test_download_part_files(self):
+        parts = []
+        for part_number in range(1, 5):
+            content = f"part {part_number}".encode("ascii")
+            url = f"http://localhost/part{part_number:02d}.mp3"
+            responses.get(url, body=content)
+            parts.append(
+                shared.PartDownload(
+                    number=part_number,
+                    url=url,
+                    file_size=len(content),
+                    filename=self.test_downloads_dir.joinpath(
+                        f"part{part_number:02d}.mp3"
+                    ),
+                )
+            )
+        for parallelism in (1, 3):
+            with self.subTest(parallelism=parallelism):
+                saved_parts = []
+                shared.download_part_files(
+                    session=shared.init_session(),
+                    parts=parts,
+                    headers={"User-Agent": "test"},
+                    timeout=10,
+                    parallelism=parallelism,
+                    hide_progress=True,
+                    ffmpeg_loglevel="fatal",
+                    logger=self.logger,
+                    on_part_saved=saved_parts.append,
+                )
+                self.assertEqual(
+                    sorted(part.number for part in saved_parts), [1, 2, 3, 4]
+                )
+                for part in parts:
+                    self.assertEqual(
+                        part.filename.read_bytes(),
+                        f"part {part.number}".encode("ascii"),
+                    )
+                    self.assertFalse(part.filename.with_suffix(".part").exists())
+                    part.filename.unlink()
+
+    @responses.activate
+    def test_download_part_file_resume(self):
+        url = "http://localhost/part01.mp3"
+        part = shared.PartDownload(
+            number=1,
+            url=url,
+            file_size=10,
+            filename=self.test_downloads_dir.joinpath("part01.mp3"),
+        )
+        part_tmp_filename = part.filename.with_suffix(".part")
+        part_validator_filename = part.filename.with_suffix(".part.etag")
+        session = shared.init_session()
+
+        # resume from the partial file if the part is unchanged
+        part_tmp_filename.write_bytes(b"01234")
+        part_validator_filename.write_text('"abc"', encoding="utf-8")
+        responses.get(
+            url,
+            body=b"56789",
+            status=206,
+            match=[
+                matchers.header_matcher(
+                    {
+                        "Range": "bytes=5-",
+                        "If-Range": '"abc"',
+                        "Accept-Encoding": "identity",
+                    }
+                )
+            ],
+        )
+        shared.download_part_file(
+            session, part, {}, timeout=10, hide_progress=True, logger=self.logger
+        )
+        self.assertEqual(part_tmp_filename.read_bytes(), b"0123456789")
+        self.assertFalse(part_validator_filename.exists())
+
+        # start over if the server sends the whole part instead
+        responses.replace(
+            responses.GET, url, body=b"abcdefghij", headers={"ETag": '"def"'}
+        )
+        shared.download_part_file(
+            session, part, {}, timeout=10, hide_progress=True, logger=self.logger
+        )
+        self.assertEqual(part_tmp_filename.read_bytes(), b"abcdefghij")
+        self.assertFalse(part_validator_filename.exists())
@@ -3,15 +3,19 @@
 # This software is released under the MIT License.
 # https://opensource.org/licenses/MIT
 
+import contextlib
+import io
 import json
+import time
 from http import HTTPStatus
 
 import responses
 from lxml import etree  # type: ignore[import]
 
 from odmpy.errors import OdmpyRuntimeError
-from odmpy.odm import run
+from odmpy.odm import REPOSITORY_URL, TAGS_ENDPOINT, run
 from odmpy.overdrive import OverDriveClient
+from odmpy.processing import odm as odm_processing
 from .base import BaseTestCase
 from .data import (
     get_expected_result,
@@ -55,6 +59,62 @@ class OdmpyTests(BaseTestCase):
                         expected.read(),
                     )
 
+    @responses.activate
+    def test_version_check(self):
+        """
+        `odmpy info test.odm` reports a new version even if the check is slow
+        """
+
+        def slow_tags(_):
+            time.sleep(1)
+            return HTTPStatus.OK, {}, json.dumps([{"name": "99.0.0"}])
+
+        responses.add_callback(responses.GET, TAGS_ENDPOINT, callback=slow_tags)
+        with self.assertLogs(run.__module__, level="WARNING") as context:
+            run(
+                ["info", str(self.test_data_dir.joinpath(self.test_odms[0]))],
+                be_quiet=True,
+            )
+        self.assertIn(
+            f"A new version 99.0.0 is available at {REPOSITORY_URL}.",
+            "\n".join([r.getMessage() for r in context.records]),
+        )
+
+    def test_parse_error_usage(self):
+        """
+        `odmpy libby --bogus` lists all the commands in the usage
+        """
+        err = io.StringIO()
+        with self.assertRaises(SystemExit) as context, contextlib.redirect_stderr(err):
+            run(["--noversioncheck", "libby", "--bogus"], be_quiet=True)
+        self.assertEqual(context.exception.code, 2)
+        self.assertIn("{libby,libbyreturn,libbyrenew,dl,ret,info}", err.getvalue())
+        self.assertIn("unrecognized arguments: --bogus", err.getvalue())
+
+    def test_info_with_comments(self):
+        """
+        `odmpy info test.odm` with comments in the odm
+        """
+        test_odm_file = "test1.odm"
+        odm_file = self.test_downloads_dir.joinpath(test_odm_file)
+        odm_file.write_text(
+            self.test_data_dir.joinpath(test_odm_file)
+            .read_text(encoding="utf-8")
+            .replace("<Formats>", "<Formats><!-- note --><?pi note?>")
+            .replace("<Parts ", "<!-- note --><Parts "),
+            encoding="utf-8",
+        )
+        expected_file = self.test_data_dir.joinpath(
+            f"{test_odm_file}.info.expected.txt"
+        )
+        with self.assertLogs(run.__module__, level="INFO") as context:
+            run(["--noversioncheck", "info", str(odm_file)], be_quiet=True)
+        with expected_file.open("r", encoding="utf-8") as expected:
+            self.assertEqual(
+                "\n".join([r.msg for r in context.records]) + "\n",
+                expected.read(),
+            )
+
     def test_info_json(self):
         """
         `odmpy info test.odm` --format json`
@@ -323,6 +383,26 @@ class OdmpyTests(BaseTestCase):
                 # close this to prevent "ResourceWarning: unclosed socket" error
                 od.session.close()
 
+    def test_patch_for_parse_error(self):
+        text = "<Title>Caf&eacute; &amp; Friends&rsquo;</Title>"
+        with self.assertRaises(etree.ParseError):
+            etree.fromstring(text, odm_processing.XML_PARSER)
+        title = etree.fromstring(
+            odm_processing._patch_for_parse_error(text), odm_processing.XML_PARSER
+        )
+        self.assertEqual(title.text, "Café & Friends’")
+
+    def test_xml_parser_external_entities(self):
+        secret_file = self.test_downloads_dir.joinpath("secret.txt")
+        secret_file.write_text("secret", encoding="utf-8")
+        text = (
+            '<?xml version="1.0"?>'
+            f'<!DOCTYPE Title [<!ENTITY xxe SYSTEM "{secret_file.as_uri()}">]>'
+            "<Title>&xxe;</Title>"
+        )
+        title = etree.fromstring(text.encode("utf-8"), odm_processing.XML_PARSER)
+        self.assertNotIn("secret", "".join(title.itertext()))
+
     @responses.activate
     def test_odm_return(self):
         """
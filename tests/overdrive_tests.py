@@ -152,6 +152,11 @@ class OverDriveClientTests(BaseTestCase):
             self.client.library_media_availability("brooklyn", "2006069")
         self.assertEqual(context.exception.response.status_code, 404)
 
+    def test_library_media_concurrent(self):
+        title_ids = ["7017021", "1330527"]
+        medias = self.client.library_media_concurrent("lapl", title_ids)
+        self.assertEqual([m["id"] for m in medias], title_ids)
+
     def test_library_media(self):
         media = self.client.library_media("lapl", "7017021")
 
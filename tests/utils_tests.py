@@ -1,10 +1,13 @@
 import argparse
+import shutil
 import string
+import tempfile
 import unittest
 from datetime import datetime
 from pathlib import Path
 from random import choices
 
+from odmpy import cache
 from odmpy import cli_utils
 from odmpy import utils
 from tests.base import is_windows
@@ -125,3 +128,32 @@ class UtilsTests(unittest.TestCase):
             with self.subTest(file_name=f):
                 mime_type = utils.guess_mimetype(f)
                 self.assertIsNotNone(mime_type, f"Unable to guess mimetype for {f}")
+
+    def test_cache(self):
+        cache_folder = Path(tempfile.mkdtemp())
+        try:
+            self.assertIsNone(cache.get(cache_folder, "abc"))
+            cache.put(cache_folder, "abc", {"a": [1, 2]}, 60)
+            self.assertEqual(cache.get(cache_folder, "abc"), {"a": [1, 2]})
+            cache.put(cache_folder, "abc", {"a": [1, 2]}, -1)
+            self.assertIsNone(cache.get(cache_folder, "abc"))
+            self.assertEqual(list(cache_folder.iterdir()), [])
+
+            # expired entries for other keys are removed on put
+            cache.put(cache_folder, "old", {"a": 1}, -1)
+            cache.put(cache_folder, "new", {"a": 2}, 60)
+            self.assertEqual(
+                [f.name for f in cache_folder.iterdir()],
+                [cache._cache_file(cache_folder, "new").name],
+            )
+
+            # errors writing to the cache are not raised
+            cache.put(cache_folder.joinpath("new.json"), "x", {"a": 3}, 60)
+
+            cache.clear(cache_folder)
+            self.assertIsNone(cache.get(cache_folder, "new"))
+            self.assertEqual(list(cache_folder.iterdir()), [])
+            # no error if there is no cache yet
+            cache.clear(cache_folder.joinpath("missing"))
+        finally:
+            shutil.rmtree(cache_folder, ignore_errors=True)